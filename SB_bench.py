@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+SB_bench.py
+
+Purpose:  Benchmark suite for the ABM. Times each phase of building an Environment, and
+          get_network, get_data and the full data concat step, with the peak memory of
+          each, across population sizes and the network families of SB_data_gen.
+          Results are written to a JSON file so that runs on different commits can be
+          compared with -c.
+
+Author:   Drew Conway
+Email:    drew.conway@nyu.edu
+Date:     2010-07-27
+
+Copyright (c) 2010, under the Simplified BSD License.
+For more information on FreeBSD see: http://www.opensource.org/licenses/bsd-license.php
+All rights reserved.
+"""
+
+import sys
+import os
+import time
+import json
+import hashlib
+import resource
+import platform
+import subprocess
+import multiprocessing
+import unittest
+import tempfile
+import shutil
+import numpy as np
+import networkx as nx
+import StateBuilding as SB
+import SB_data_gen
+from optparse import OptionParser
+
+# Population sizes benchmarked by default
+SIZES=[150,1000,10000,100000]
+# Largest population each family can be generated for here. A G(n,.5) network has
+# about n^2/4 ties, so the binomial family is capped.
+MAX_SIZE={"binom":3000}
+# Number of runs concatenated by the concat benchmark
+CONCAT_RUNS=10
+
+def peak_rss():
+    """Returns the peak resident set size of this process, in kB"""
+    rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on OS X, and kB on Linux
+    return rss//1024 if sys.platform=="darwin" else rss
+
+def timed(phases,phase,func,*args):
+    """Calls func(*args), and appends the phase's wall-clock time and the peak memory so
+    far to phases"""
+    start=time.time()
+    value=func(*args)
+    phases.append({"phase": phase, "seconds": time.time()-start, "peak_rss_kb": peak_rss()})
+    return value
+
+def build_phases(phases,family,size,seed):
+    """Builds an Environment, recording each of its phases through the Environment's
+    hook, and returns it"""
+    degree_seq=timed(phases,"degree_sequence",SB_data_gen.degree_sequence,family,size,np.random.RandomState(seed))
+    def hook(env,phase,seconds,nbytes):
+        phases.append({"phase": phase, "seconds": seconds, "peak_rss_kb": peak_rss(), "result_bytes": nbytes,
+            "peak_rss_growth": env.peak_rss_growth[phase]})
+    return SB.Environment(size,degree_seq,seed=seed,hook=hook)
+
+def bench_case(case):
+    """Runs one benchmark case, (family, size, seed), in a fresh process and returns
+    its result. Family "concat" times the consolidation of CONCAT_RUNS per-run CSV files
+    into a FULL file, as run_ensemble does (see SB_data_gen.consolidate_runs)."""
+    family,size,seed=case
+    result={"family": family, "size": size, "baseline_rss_kb": peak_rss(), "phases": []}
+    phases=result["phases"]
+    scratch=tempfile.mkdtemp()
+    try:
+        if family=="concat":
+            SB_data_gen.make_data_dirs(scratch)
+            for r in xrange(CONCAT_RUNS):
+                SB_data_gen.run_task(("pref",r,size,scratch,seed,"csv",False))
+            manifest=SB_data_gen.Manifest(scratch+"/manifest.jsonl")
+            completed=set(("pref",r) for r in xrange(CONCAT_RUNS))
+            timed(phases,"concat",SB_data_gen.consolidate_runs,manifest,scratch,"pref",0,completed,hashlib.md5())
+            manifest.close()
+        else:
+            env=build_phases(phases,family,size,seed)
+            timed(phases,"get_network",env.get_network)
+            # Recorded as the "output" phase by the hook
+            env.get_data(scratch+"/data.csv")
+    except Exception as error:
+        result["error"]="%s: %s" % (type(error).__name__,error)
+    finally:
+        shutil.rmtree(scratch)
+    return result
+
+def git_commit():
+    """Returns the checked out commit of the repository, or None"""
+    try:
+        return subprocess.check_output(["git","rev-parse","HEAD"],cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull,"w")).strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(sizes=SIZES,families=None,seed=0,out_path=None):
+    """Runs every (family, size) case, each in its own process so that peak memory is
+    per case, and returns the results. Families default to all of SB_data_gen's families
+    plus the concat step. If out_path is given results are also written there as JSON."""
+    if families is None:
+        families=[f for f,d in SB_data_gen.FAMILIES]+["concat"]
+    cases=[]
+    skipped=[]
+    for family in families:
+        for size in sizes:
+            if size>MAX_SIZE.get(family,size):
+                skipped.append({"family": family, "size": size, "skipped": "above MAX_SIZE for family"})
+            else:
+                cases.append((family,size,seed))
+    pool=multiprocessing.Pool(processes=1,maxtasksperchild=1)
+    try:
+        results=[]
+        for result in pool.imap(bench_case,cases):
+            results.append(result)
+            print "%(family)s, %(size)d agents: " % result+(result.get("error") or
+                ", ".join("%s %.3fs" % (p["phase"],p["seconds"]) for p in result["phases"]))
+    finally:
+        pool.close()
+        pool.join()
+    report={"commit": git_commit(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+        "numpy": np.__version__, "networkx": nx.__version__, "seed": seed, "results": results+skipped}
+    if out_path is not None:
+        json.dump(report,open(out_path,"w"),indent=1)
+    return report
+
+def compare(old,new):
+    """Returns (family, size, phase, old seconds, new seconds) for every phase timed in
+    both benchmark reports"""
+    old_phases=dict(((r["family"],r["size"],p["phase"]),p["seconds"]) for r in old["results"] for p in r.get("phases",[]))
+    rows=[]
+    for r in new["results"]:
+        for p in r.get("phases",[]):
+            key=(r["family"],r["size"],p["phase"])
+            if key in old_phases:
+                rows.append(key+(old_phases[key],p["seconds"]))
+    return rows
+
+class TestBench(unittest.TestCase):
+    """Test case for the benchmark suite"""
+
+    def test_run_benchmarks(self):
+        """Test that every family and size is benchmarked, or skipped, and reported"""
+        out_dir=tempfile.mkdtemp()
+        try:
+            report=run_benchmarks(sizes=[40,5000],families=["binom","pref","concat"],out_path=out_dir+"/bench.json")
+            self.assertEquals(report,json.load(open(out_dir+"/bench.json")))
+        finally:
+            shutil.rmtree(out_dir)
+        results=dict(((r["family"],r["size"]),r) for r in report["results"])
+        self.assertEquals(len(results),6)
+        self.assertTrue("skipped" in results[("binom",5000)])
+        self.assertEquals([p["phase"] for p in results[("binom",40)]["phases"]],
+            ["degree_sequence","population","network","mnet","contribs","evaluate","get_network","output"])
+        self.assertEquals([p["phase"] for p in results[("concat",40)]["phases"]],["concat"])
+        for p in results[("pref",5000)]["phases"]:
+            self.assertTrue(p["seconds"]>=0 and p["peak_rss_kb"]>0)
+            self.assertTrue(p.get("peak_rss_growth",0)>=0)
+        self.assertEquals(len(compare(report,report)),3*8+2)
+
+
+if __name__ == '__main__':
+    parser=OptionParser()
+    parser.add_option("-n","--sizes",default=",".join(map(str,SIZES)),help="comma-separated population sizes")
+    parser.add_option("-f","--families",default=None,help="comma-separated families (default all, and concat)")
+    parser.add_option("-s","--seed",type="int",default=0,help="random seed")
+    parser.add_option("-o","--out",default="SB_bench.json",help="JSON file for results")
+    parser.add_option("-c","--compare",default=None,help="earlier JSON results to compare against")
+    (options,args)=parser.parse_args()
+    families=None if options.families is None else options.families.split(",")
+    report=run_benchmarks(map(int,options.sizes.split(",")),families,options.seed,options.out)
+    if options.compare is not None:
+        for family,size,phase,old_seconds,new_seconds in compare(json.load(open(options.compare)),report):
+            print "%s, %d agents, %s: %.3fs -> %.3fs (%.2fx)" % (family,size,phase,old_seconds,new_seconds,
+                new_seconds/old_seconds if old_seconds>0 else float("inf"))
@@ -17,9 +17,22 @@ All rights reserved.
 import sys
 import os
 import StateBuilding as SB  
-import networkx as nx
+import SB_degree
+import SB_store
 import zipfile
 import csv
+import time
+import itertools
+import collections
+import math
+import multiprocessing
+import json
+import hashlib
+import unittest
+import numpy as np
+import tempfile
+import shutil
+from optparse import OptionParser
 
 
 '''
@@ -67,84 +80,874 @@ def dirEntries(dir_name, subdir, *args):
             fileList.extend(dirEntries(dirfile, subdir, *args))
     return fileList
 
-def main():
-    # Base parameters
-    num_runs=500
-    num_agents=150
+# Network families simulated in each run: (key, data sub-directory). A family's position
+# in this list is part of the seed of each of its tasks, so new families must be appended.
+FAMILIES=[("binom","binomial"),("uni","uniform"),("pref","pref_attach"),("par","pareto"),("pl","power_law")]
+
+def task_seed(master_seed,family,run):
+    """Returns the seed of a (family, run) task. Seeds are sequences of ints, which NumPy 
+    hashes into the initial state of an independent Mersenne Twister stream per task."""
+    return [master_seed,[f[0] for f in FAMILIES].index(family),run]
+
+def common_seed(master_seed,run):
+    """Returns the seed of the population shared by every family of a run in common random
+    numbers mode. Its stream is distinct from those of task_seed."""
+    return [master_seed,run]
+
+def degree_sequence(family,num_agents,rng=None):
+    """Returns a degree sequence for a network family, drawn from rng (default the global
+    NumPy random state), or None for the wealth-based preferential attachment family 
+    (the Environment default)"""
+    if family in SB_degree.SAMPLERS:
+        return SB_degree.SAMPLERS[family](num_agents,rng=rng)
+    return None
+
+# Columns of the columnar agent table, and their on-disk types
+AGENT_COLUMNS=[("run","<i4"),("wealth","<f8"),("disposition","i1"),("type","i1"),("num_neighbors","<i4"),
+    ("contrib","<f8"),("threshold","<f8"),("threshold_met","i1")]
+
+class ColumnStore(object):
+    """Columnar dataset on disk, stored as a directory with one raw binary file per 
+    column plus a JSON schema. Rows are appended in chunks (e.g. one run at a time)
+    directly to each column file, and the dataset is read back with load_columns().
+    """
+    def __init__(self, path, schema=AGENT_COLUMNS):
+        self.path=path
+        self.schema=[(name,np.dtype(dtype)) for name,dtype in schema]
+        try:
+            os.mkdir(path)
+        except(OSError):
+            pass
+        json.dump([(name,dtype.str) for name,dtype in self.schema],open(path+"/schema.json","w"))
+        self.files=dict((name,open(path+"/"+name+".bin","wb")) for name,dtype in self.schema)
+        self.num_rows=0
+        
+    def append(self, columns):
+        """Appends a chunk of rows given as a dict of equal-length column arrays"""
+        length=len(columns[self.schema[0][0]])
+        for name,dtype in self.schema:
+            column=np.asarray(columns[name],dtype=dtype)
+            if len(column)!=length:
+                raise ValueError("All columns must have the same length")
+            column.tofile(self.files[name])
+        self.num_rows+=length
+        
+    def close(self):
+        for f in self.files.values():
+            f.close()
+            
+def load_columns(path, mmap=True):
+    """Returns a dict of the column arrays of a ColumnStore, memory-mapped by default"""
+    columns={}
+    for name,dtype in json.load(open(path+"/schema.json")):
+        if mmap and os.path.getsize(path+"/"+name+".bin")>0:
+            columns[name]=np.memmap(path+"/"+name+".bin",dtype=dtype,mode="r")
+        else:
+            columns[name]=np.fromfile(path+"/"+name+".bin",dtype=dtype)
+    return columns
+
+def run_columns(E,run):
+    """Returns a run's agent table as a dict of columns"""
+    num_agents=E.num_agents()
+    columns=E.get_columns()
+    columns.update({"run":np.repeat(run,num_agents),"threshold":np.repeat(E.get_threshold(),num_agents),
+        "threshold_met":np.repeat(int(E.good_provided()),num_agents)})
+    return columns
+
+def build_environment(family,run,num_agents,master_seed,common=False):
+    """Returns the Environment of a (family, run) task.
     
-    # Set up directory structure for data storage
-    data_dir="ABM_data" # Directory for all ABM data outout
-    sub_dirs={"binom":"binomial","uni":"uniform","pref":"pref_attach","par":"pareto","pl":"power_law"}   # All sub-directries
-    # Create directories
+    Every task draws from its own random streams, derived from the master seed, so results
+    are identical whichever worker runs the task and however many workers there are.
+    
+    With common=True (common random numbers) the Environment is seeded per run rather than 
+    per task, so every family of a run plays the game with the same agents: the same wealth,
+    disposition and type, and the same draws for Miserly and zero m_net contributions. Only
+    the network varies between families, and paired differences between families have far
+    less variance than differences between independent runs.
+    """
+    # Degree sequences are drawn from a stream of their own, separate from the Environment's
+    degree_seq=degree_sequence(family,num_agents,np.random.RandomState(task_seed(master_seed,family,run)+[0]))
+    return SB.Environment(population=num_agents,degree_seq=degree_seq,seed=environment_seed(master_seed,family,run,common))
+
+def environment_seed(master_seed,family,run,common=False):
+    """Returns the seed of a (family, run) task's Environment (see build_environment)"""
+    return common_seed(master_seed,run) if common else task_seed(master_seed,family,run)
+
+def run_task(task):
+    """Runs a single (family, run) simulation. For CSV output the run's data is written
+    to its own file, and for SQLite output it is added to the ResultStore 
+    <data_dir>/results.db by this worker; otherwise its agent table is returned as 
+    columns. The run's phase timings (see Environment.timings) are returned with it.
+    """
+    family,run,num_agents,data_dir,master_seed,output,common=task
+    E=build_environment(family,run,num_agents,master_seed,common)
+    if output=="sqlite":
+        store=SB_store.ResultStore(data_dir+"/results.db")
+        try:
+            E.get_data(store=store,family=family,run=run)
+        finally:
+            store.close()
+        return family,run,None,E.timings
+    if output!="csv":
+        return family,run,run_columns(E,run),E.timings
+    path=run_path(data_dir,family,run)
+    # Written under a temporary name and renamed into place, so that a run's file is 
+    # either whole or missing, however the sweep is interrupted
+    E.get_data(path+".tmp")
+    os.rename(path+".tmp",path)
+    record={"family":family,"run":run,"num_agents":num_agents,"seed":environment_seed(master_seed,family,run,common)}
+    record.update(file_record(path))
+    return family,run,record,E.timings
+
+def run_path(data_dir,family,run):
+    """Returns the path of a (family, run) task's CSV file"""
+    sub_dir=dict(FAMILIES)[family]
+    return data_dir+"/"+sub_dir+"/"+str(run)+"_"+sub_dir+".csv"
+
+def file_md5(path,nbytes=None,chunk_size=2**20):
+    """Returns the MD5 hash object of a file, or of its first nbytes, read in chunks"""
+    digest=hashlib.md5()
+    with open(path,"rb") as f:
+        remaining=nbytes
+        while remaining is None or remaining>0:
+            chunk=f.read(chunk_size if remaining is None else min(chunk_size,remaining))
+            if not chunk:
+                break
+            digest.update(chunk)
+            if remaining is not None:
+                remaining-=len(chunk)
+    return digest
+
+def file_record(path):
+    """Returns the path, size and MD5 checksum of a file"""
+    return {"file":path,"bytes":os.path.getsize(path),"md5":file_md5(path).hexdigest()}
+
+class Manifest(object):
+    """Journal of a CSV sweep, kept at path as one JSON record per line: a record per 
+    completed (family, run) task with its parameters and its file's size and checksum,
+    a record each time a family's FULL file has consolidated another run, with the FULL
+    file's size and checksum, and a record each time a FULL file is cut back to its first
+    runs, which drops the family's later checkpoints. Records are flushed to disk as they
+    are appended.
+    
+    With resume=True an existing journal is read back, skipping a line torn by an
+    interruption, and rewritten compactly; otherwise a new journal is started.
+    """
+    def __init__(self, path, resume=False):
+        self.path=path
+        # Completed tasks keyed by (family, run)
+        self.tasks={}
+        # Size and checksum of each family's FULL file after its first k runs, keyed by 
+        # family and k
+        self.consolidated={}
+        records=[]
+        if resume and os.path.exists(path):
+            for line in open(path):
+                try:
+                    record=json.loads(line)
+                except ValueError:
+                    continue
+                records.append(record)
+                if "consolidated" in record:
+                    self.consolidated.setdefault(record["family"],{})[record["consolidated"]]=(record["bytes"],record["md5"])
+                elif "reset" in record:
+                    self._drop(record["family"],record["reset"])
+                else:
+                    self.tasks[(record["family"],record["run"])]=record
+        # Rewritten in place atomically, dropping any torn line
+        f=open(path+".tmp","w")
+        for record in records:
+            f.write(json.dumps(record)+"\n")
+        f.close()
+        os.rename(path+".tmp",path)
+        self.file=open(path,"a")
+        
+    def append(self, record):
+        self.file.write(json.dumps(record)+"\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        
+    def _drop(self, family, runs):
+        checkpoints=self.consolidated.get(family,{})
+        for k in [k for k in checkpoints if k>runs]:
+            del checkpoints[k]
+        
+    def reset(self, family, runs):
+        """Records that a family's FULL file was cut back to its first runs, dropping the 
+        checkpoints of any later runs"""
+        if any(k>runs for k in self.consolidated.get(family,{})):
+            self._drop(family,runs)
+            self.append({"family":family,"reset":runs})
+        
+    def completed(self, family, run, num_agents, seed, path):
+        """Returns True if the task was completed with the same parameters, and its file 
+        is still whole"""
+        record=self.tasks.get((family,run))
+        if record is None or (record["num_agents"],record["seed"],record["file"])!=(num_agents,seed,path):
+            return False
+        return os.path.exists(path) and file_record(path)==dict((k,record[k]) for k in ("file","bytes","md5"))
+        
+    def close(self):
+        self.file.close()
+
+def consolidate_runs(manifest,data_dir,family,next_run,completed,digest,chunk_size=2**20):
+    """Appends a family's completed runs, from next_run on and in run order, to its FULL
+    file (with the header of the first run only, as concat_runs), checkpointing each one
+    in the manifest with the checksum of the FULL file so far. digest is the MD5 hash 
+    object of the FULL file's current contents, and is updated as runs are appended.
+    Returns the next run to be consolidated."""
+    d=dict(FAMILIES)[family]
+    full_path=data_dir+"/"+d+"/FULL_"+d+".csv"
+    while (family,next_run) in completed:
+        with open(run_path(data_dir,family,next_run),"rb") as run_file:
+            if next_run>0:
+                run_file.readline()
+            with open(full_path,"ab") as full_file:
+                for chunk in iter(lambda: run_file.read(chunk_size),""):
+                    full_file.write(chunk)
+                    digest.update(chunk)
+                full_file.flush()
+                os.fsync(full_file.fileno())
+        next_run+=1
+        manifest.append({"family":family,"consolidated":next_run,"bytes":os.path.getsize(full_path),"md5":digest.hexdigest()})
+    return next_run
+
+def run_summary(E):
+    """Returns a run's summary: whether the public good was provided, total contributions,
+    and the total contributions of each agent type present"""
+    given=np.bincount(E.agents.type,weights=E.agents.contrib*E.agents.wealth)
+    present=np.bincount(E.agents.type)
+    return {"threshold_met": int(E.good_provided()), "total_contribs": E.get_total_contribs(),
+        "type_contribs": dict((int(t),float(given[t])) for t in np.flatnonzero(present))}
+
+def summary_task(task):
+    """Runs a single (family, run, num_agents, master_seed, common) simulation and returns
+    its summary"""
+    family,run,num_agents,master_seed,common=task
+    return family,run,run_summary(build_environment(family,run,num_agents,master_seed,common))
+
+class RunningMean(object):
+    """Online mean and variance of a statistic, updated one value at a time (Welford)"""
+    def __init__(self):
+        self.count=0
+        self.mean=0.0
+        self._sum_squares=0.0
+        # Whether every value so far has been 0 or 1
+        self.binary=True
+        
+    def add(self, value):
+        self.binary=self.binary and value in (0,1)
+        self.count+=1
+        delta=value-self.mean
+        self.mean+=delta/self.count
+        self._sum_squares+=delta*(value-self.mean)
+        
+    def add_many(self, values):
+        """Adds an array of values at once, merging its mean and variance (Chan et al.)"""
+        values=np.asarray(values,dtype=float)
+        if len(values)==0:
+            return
+        self.binary=self.binary and bool(((values==0) | (values==1)).all())
+        mean=values.mean()
+        total=self.count+len(values)
+        delta=mean-self.mean
+        self.mean+=delta*len(values)/total
+        self._sum_squares+=((values-mean)**2).sum()+delta**2*self.count*len(values)/total
+        self.count=total
+        
+    def variance(self):
+        """Returns the sample variance, or 0 for fewer than two values"""
+        return self._sum_squares/(self.count-1) if self.count>1 else 0.0
+        
+    def ci_width(self, z=1.96):
+        """Returns the width of the normal confidence interval mean +/- z standard errors.
+        For a binary statistic (e.g. provision) the Wilson score interval is used instead,
+        which stays wide when every value so far is 0 or every value is 1."""
+        if self.count==0:
+            return float("inf")
+        if self.binary:
+            n=float(self.count)
+            p=self.mean
+            return 2*z*math.sqrt(p*(1-p)/n+z*z/(4*n*n))/(1+z*z/n)
+        return 2*z*math.sqrt(self.variance()/self.count)
+
+def _add_counts(counts,bins,shape=()):
+    """Returns counts (an array of the given leading shape by a number of bins that grows
+    as needed) plus the number of values in each bin. bins is a tuple of index arrays, 
+    one per leading dimension and then the bin."""
+    width=max(counts.shape[-1],int(bins[-1].max())+1 if len(bins[-1]) else 0)
+    if width>counts.shape[-1]:
+        counts=np.concatenate((counts,np.zeros(shape+(width-counts.shape[-1],),dtype=counts.dtype)),axis=-1)
+    flat=np.ravel_multi_index(bins,shape+(width,))
+    counts+=np.bincount(flat,minlength=counts.size).reshape(counts.shape)
+    return counts
+
+class Aggregates(object):
+    """Online summaries of a family's agent tables, as plotted by SB_analysis.R, kept in 
+    memory of a fixed size however many runs are added. Runs' agent tables (see 
+    run_columns) are added with append(), and close() writes the summaries to path as JSON.
+    
+        degree_hist:            Number of agents with each degree (degree_dist)
+        contrib_hist:           Agents by threshold_met, type and contribution bin of width .1 (contrib_bins)
+        type_wealth_hist:       Agents by type and wealth bin of width 20 (type_bins)
+        wealth_contrib_hist:    Agents with disposition 1 by threshold_met, type, wealth bin of width 1 
+                                below 30, and contribution bin of width .05 (wealth_contrib)
+        stats:                  Running means and variances of contrib, wealth and num_neighbors by type
+        provision:              Running mean and variance of threshold_met over runs
+    """
+    # Bin widths, and number of bins for bounded values
+    CONTRIB_BINS=10
+    WEALTH_BIN=20
+    SCATTER_WEALTH_BINS=30
+    SCATTER_CONTRIB_BINS=20
+    
+    def __init__(self, path=None):
+        self.path=path
+        self.num_types=max(SB.CONTRIB_RULES)+1
+        self.degree_hist=np.zeros(0,dtype=int)
+        self.contrib_hist=np.zeros((2,self.num_types,self.CONTRIB_BINS),dtype=int)
+        self.type_wealth_hist=np.zeros((self.num_types,0),dtype=int)
+        self.wealth_contrib_hist=np.zeros((2,self.num_types,self.SCATTER_WEALTH_BINS,self.SCATTER_CONTRIB_BINS),dtype=int)
+        self.stats=dict((name,[RunningMean() for t in xrange(self.num_types)]) for name in ("contrib","wealth","num_neighbors"))
+        self.provision=RunningMean()
+        self.num_runs=0
+        
+    def _bin(self, values, bins, width=None):
+        """Returns the bin of each value in [0,1] among bins equal bins, or of width width"""
+        if width is not None:
+            return (np.asarray(values)//width).astype(int)
+        return np.minimum((np.asarray(values)*bins).astype(int),bins-1)
+        
+    def append(self, columns):
+        """Adds a run's agent table given as a dict of column arrays"""
+        agent_type=np.asarray(columns["type"],dtype=int)
+        met=np.asarray(columns["threshold_met"],dtype=int)
+        contrib=np.asarray(columns["contrib"])
+        wealth=np.asarray(columns["wealth"])
+        self.degree_hist=_add_counts(self.degree_hist,(np.asarray(columns["num_neighbors"],dtype=int),))
+        self.contrib_hist=_add_counts(self.contrib_hist,(met,agent_type,self._bin(contrib,self.CONTRIB_BINS)),(2,self.num_types))
+        self.type_wealth_hist=_add_counts(self.type_wealth_hist,(agent_type,self._bin(wealth,None,self.WEALTH_BIN)),(self.num_types,))
+        shown=(np.asarray(columns["disposition"])>0) & (wealth<self.SCATTER_WEALTH_BINS)
+        self.wealth_contrib_hist=_add_counts(self.wealth_contrib_hist,(met[shown],agent_type[shown],self._bin(wealth[shown],None,1),
+            self._bin(contrib[shown],self.SCATTER_CONTRIB_BINS)),(2,self.num_types,self.SCATTER_WEALTH_BINS))
+        for name,stats in self.stats.items():
+            values=np.asarray(columns[name])
+            for t in np.unique(agent_type):
+                stats[t].add_many(values[agent_type==t])
+        if len(met)>0:
+            self.provision.add(met[0])
+        self.num_runs+=1
+        
+    def summary(self):
+        """Returns all summaries as a dict of lists and numbers"""
+        stat=lambda r: {"count": r.count, "mean": r.mean, "variance": r.variance()}
+        return {"num_runs": self.num_runs, "degree_hist": self.degree_hist.tolist(),
+            "contrib_hist": self.contrib_hist.tolist(), "type_wealth_hist": self.type_wealth_hist.tolist(),
+            "wealth_contrib_hist": self.wealth_contrib_hist.tolist(), "provision": stat(self.provision),
+            "stats": dict((name,[stat(r) for r in stats]) for name,stats in self.stats.items())}
+            
+    def close(self):
+        if self.path is not None:
+            json.dump(self.summary(),open(self.path,"w"))
+
+def iter_runs(num_runs,num_agents,master_seed=0,workers=None,families=None,target_width=None,
+    statistic="threshold_met",min_runs=30,z=1.96,common=False):
+    """Yields (family, run, summary) for up to num_runs runs of each family (default all),
+    with summaries as returned by run_summary, interleaving families run by run. Runs are
+    computed on a pool of worker processes (default one per CPU) a few tasks ahead, but 
+    each family's runs are yielded in run order, so output does not depend on workers.
+    
+    If target_width is given a family stops once it has had min_runs runs and the 
+    confidence interval of its statistic (a summary key, or a function of the summary,
+    by default the provision rate; see RunningMean.ci_width) is narrower than target_width. Runs already computed
+    for a stopped family are discarded. With common=True the families of a run share
+    their population (see build_environment).
+    """
+    if families is None:
+        families=[f[0] for f in FAMILIES]
+    if isinstance(statistic,basestring):
+        statistic=lambda summary,key=statistic: summary[key]
+    stats=dict((f,RunningMean()) for f in families)
+    next_run=dict.fromkeys(families,0)
+    open_families=list(families)
+    if workers==1:
+        pool=None
+        capacity=1
+    else:
+        pool=multiprocessing.Pool(workers)
+        capacity=2*(workers or multiprocessing.cpu_count())
+    # Submitted tasks, collected in submission order
+    submitted=collections.deque()
+    try:
+        while open_families:
+            # Keep the pool busy, submitting the next run of each open family in turn
+            while len(submitted)<capacity:
+                waiting=[f for f in open_families if next_run[f]<num_runs]
+                if not waiting:
+                    break
+                family=min(waiting,key=lambda f: next_run[f])
+                task=(family,next_run[family],num_agents,master_seed,common)
+                next_run[family]+=1
+                submitted.append(task if pool is None else pool.apply_async(summary_task,(task,)))
+            if not submitted:
+                break
+            result=submitted.popleft()
+            family,run,summary=summary_task(result) if pool is None else result.get()
+            if family not in open_families:
+                continue
+            stats[family].add(statistic(summary))
+            yield family,run,summary
+            if run+1==num_runs or (target_width is not None and stats[family].count>=min_runs and 
+                stats[family].ci_width(z)<target_width):
+                open_families.remove(family)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+def report_progress(done,total,start_time):
+    """Prints progress to stdout each time another 10% of tasks has completed"""
+    if done==total or (done*10)/total>((done-1)*10)/total:
+        print "Simulation %d%% complete (%d of %d tasks, %.1fs elapsed)" % ((done*100)/total,done,total,time.time()-start_time)
+
+def run_ensemble(num_runs,num_agents,data_dir,master_seed=0,workers=None,output="csv",common=False,resume=False):
+    """Fans the (family, run) tasks out over a pool of worker processes (default one per 
+    CPU). With workers=1 tasks are run in this process. With common=True the families of
+    a run share their population (see build_environment).
+    
+    With output="csv" each run is written to <family>/<run>_<family>.csv, and appended in
+    run order to <family>/FULL_<family>.csv as it completes. Completed tasks and 
+    consolidated runs are recorded in the Manifest <data_dir>/manifest.jsonl. With 
+    resume=True a sweep that was interrupted is picked up: tasks completed with the same
+    parameters whose files are still whole are skipped, and each FULL file is truncated
+    back to the last of its consolidated runs that is still valid. With
+    output="columns" each run's agent table is appended, in run order, to the single
+    ColumnStore <family>/FULL_<family> as it completes. With output="aggregates" it is
+    added to the family's Aggregates instead, written to <family>/aggregates.json, and
+    no agent data is stored. With output="sqlite" workers add their runs directly to the
+    single ResultStore <data_dir>/results.db, replacing those of an earlier sweep with
+    the same parameters.
+    
+    Returns the ensemble's telemetry: a dict of the total seconds spent in each phase of
+    the runs, summed over all tasks, keyed by (family, phase).
+    """
+    if output not in ("csv","columns","aggregates","sqlite"):
+        raise ValueError("Output must be 'csv', 'columns', 'aggregates' or 'sqlite'")
+    if resume and output!="csv":
+        raise ValueError("Only CSV output can be resumed")
+    tasks=[(f[0],r,num_agents,data_dir,master_seed,output,common) for r in xrange(num_runs) for f in FAMILIES]
+    if output=="csv":
+        manifest=Manifest(data_dir+"/manifest.jsonl",resume)
+        # Tasks whose files are ready to be consolidated, and the next run of each family to be
+        # consolidated
+        completed=set((f,r) for f,r,a,d,s,o,c in tasks if 
+            manifest.completed(f,r,a,environment_seed(s,f,r,c),run_path(d,f,r)))
+        tasks=[t for t in tasks if (t[0],t[1]) not in completed]
+        next_run={}
+        # MD5 hash object of each family's FULL file so far
+        digests={}
+        for f,d in FAMILIES:
+            full_path=data_dir+"/"+d+"/FULL_"+d+".csv"
+            next_run[f]=0
+            digests[f]=hashlib.md5()
+            # The FULL file is valid up to the last checkpoint before any task to be rerun
+            # whose size and checksum still match the start of the file
+            rerun=min([r for r in xrange(num_runs) if (f,r) not in completed]+[num_runs])
+            size=os.path.getsize(full_path) if os.path.exists(full_path) else 0
+            checkpoints=manifest.consolidated.get(f,{})
+            for k in sorted(checkpoints,reverse=True):
+                nbytes,md5=checkpoints[k]
+                if k<=rerun and nbytes<=size:
+                    digest=file_md5(full_path,nbytes)
+                    if digest.hexdigest()==md5:
+                        next_run[f]=k
+                        digests[f]=digest
+                        break
+            if next_run[f]>0:
+                with open(full_path,"r+b") as full_file:
+                    full_file.truncate(checkpoints[next_run[f]][0])
+            elif os.path.exists(full_path):
+                os.remove(full_path)
+            # Later checkpoints no longer describe the FULL file
+            manifest.reset(f,next_run[f])
+    if output=="columns":
+        stores=dict((f,ColumnStore(data_dir+"/"+d+"/FULL_"+d)) for f,d in FAMILIES)
+    elif output=="aggregates":
+        stores=dict((f,Aggregates(data_dir+"/"+d+"/aggregates.json")) for f,d in FAMILIES)
+    elif output=="sqlite":
+        # Create the database before workers open it
+        SB_store.ResultStore(data_dir+"/results.db").close()
+    if output in ("columns","aggregates"):
+        # Runs that completed ahead of an earlier run of the same family, keyed by (family, run)
+        pending={}
+        next_run=dict.fromkeys(stores,0)
+    telemetry={}
+    start_time=time.time()
+    if workers==1:
+        pool=None
+        results=itertools.imap(run_task,tasks)
+    else:
+        pool=multiprocessing.Pool(workers)
+        results=pool.imap_unordered(run_task,tasks,chunksize=max(1,len(tasks)/(50*(workers or multiprocessing.cpu_count()))))
+    if output=="csv":
+        # Consolidate runs completed before an interruption
+        for f,d in FAMILIES:
+            next_run[f]=consolidate_runs(manifest,data_dir,f,next_run[f],completed,digests[f])
+    for done,(family,run,columns,timings) in enumerate(results):
+        for phase,seconds in timings.items():
+            telemetry[(family,phase)]=telemetry.get((family,phase),0.0)+seconds
+        if output in ("columns","aggregates"):
+            pending[(family,run)]=columns
+            while (family,next_run[family]) in pending:
+                stores[family].append(pending.pop((family,next_run[family])))
+                next_run[family]+=1
+        elif output=="csv":
+            manifest.append(columns)
+            completed.add((family,run))
+            next_run[family]=consolidate_runs(manifest,data_dir,family,next_run[family],completed,digests[family])
+        report_progress(done+1,len(tasks),start_time)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if output=="csv":
+        manifest.close()
+    if output in ("columns","aggregates"):
+        for store in stores.values():
+            store.close()
+    return telemetry
+
+def report_telemetry(telemetry):
+    """Prints the total seconds spent in each phase of each family's runs"""
+    for family,d in FAMILIES:
+        phases=sorted((phase,seconds) for (f,phase),seconds in telemetry.items() if f==family)
+        if phases:
+            print d+": "+", ".join("%s %.3fs" % p for p in phases)
+
+def make_data_dirs(data_dir):
+    """Creates the directory structure for data storage, one sub-directory per family"""
     try:
         os.mkdir(data_dir)
     except(OSError):
         pass
-    for d in sub_dirs.values():
+    for d in dict(FAMILIES).values():
         try:
             os.mkdir(data_dir+"/"+d)
         except(OSError):
             pass
-    
-    ###### SIMULATION RUNS ######
-    for r in xrange(num_runs):
-        ### Group 1: Binomial random networks ###
-        # Create random GNP network, and get degree sequence
-        gnp=nx.generators.gnp_random_graph(num_agents,p=.5)
-        binom_ds=gnp.degree()   
-        E_BINOM=SB.Environment(population=num_agents,degree_seq=binom_ds)
-        E_BINOM.get_data(data_dir+"/"+sub_dirs["binom"]+"/"+str(r)+"_"+sub_dirs["binom"]+".csv")
-    
-        ### Group 2: Uniform degree distirbution random networks ###
-        # Create unidform degree sequence
-        uni_ds=nx.create_degree_sequence(num_agents,nx.utils.uniform_sequence)
-        E_UNI=SB.Environment(population=num_agents,degree_seq=uni_ds)
-        E_UNI.get_data(data_dir+"/"+sub_dirs["uni"]+"/"+str(r)+"_"+sub_dirs["uni"]+".csv")
-        
-        ### Group 3: Prefential attachment by agent wealth parameter (class default) ###
-        E_PREF=SB.Environment(population=num_agents)
-        E_PREF.get_data(data_dir+"/"+sub_dirs["pref"]+"/"+str(r)+"_"+sub_dirs["pref"]+".csv")
-        
-        ### Group 4: Pareto degree distribution random networks ###
-        par_ds=nx.create_degree_sequence(num_agents,nx.utils.pareto_sequence)
-        E_PAR=SB.Environment(population=num_agents,degree_seq=par_ds)
-        E_PAR.get_data(data_dir+"/"+sub_dirs["par"]+"/"+str(r)+"_"+sub_dirs["par"]+".csv")
-        
-        ### Group 5: Power-law degree distribution random networks ###
-        pl_ds=nx.create_degree_sequence(num_agents,nx.utils.powerlaw_sequence)
-        E_PL=SB.Environment(population=num_agents,degree_seq=pl_ds)
-        E_PL.get_data(data_dir+"/"+sub_dirs["pl"]+"/"+str(r)+"_"+sub_dirs["pl"]+".csv")
-        
-        # Update the stdout on progress. Dumb method, but straightforward
-        if r==num_runs*.25:
-            # 25% complete
-            print "Simulation "+str((float(r)/num_runs)*100)+"% complete"
-        else:
-            if r==num_runs*.5:
-                print "Simulation "+str((float(r)/num_runs)*100)+"% complete"
-            else:
-                if r==num_runs*.75:
-                    print "Simulation "+str((float(r)/num_runs)*100)+"% complete"
-    
-    print "SIMULATION COMPLETE"
-    print ""
-    
-    # Create single CSV file from all saved files for each network type
-    for d in sub_dirs.values():
+
+def concat_runs(data_dir,num_runs,sub_dirs):
+    """Concatenates the per-run CSV files of each network type sub-directory into a 
+    single FULL_<sub_dir>.csv file"""
+    for d in sub_dirs:
         for r in xrange(num_runs):
             dr=csv.DictReader(open(data_dir+"/"+d+"/"+str(r)+"_"+d+".csv","r"))
             if r==0:
-                dw=csv.DictWriter(open(data_dir+"/"+d+"/FULL_"+d+".csv", "w"),fieldnames=dr.fieldnames)
+                full_file=open(data_dir+"/"+d+"/FULL_"+d+".csv", "w")
+                dw=csv.DictWriter(full_file,fieldnames=dr.fieldnames)
                 header=dict(zip(dr.fieldnames,dr.fieldnames))
                 dw.writerow(header)
             for row in dr:
                 dw.writerow(row)
+        if num_runs>0:
+            full_file.close()
+
+def main(num_runs=500,num_agents=150,master_seed=0,workers=None,output="csv",profile=False,common=False,resume=False):
+    # Set up directory structure for data storage
+    data_dir="ABM_data" # Directory for all ABM data outout
+    make_data_dirs(data_dir)
+    
+    ###### SIMULATION RUNS ######
+    telemetry=run_ensemble(num_runs,num_agents,data_dir,master_seed,workers,output,common,resume)
+    
+    print "SIMULATION COMPLETE"
+    print ""
+    if profile:
+        report_telemetry(telemetry)
+        print ""
+    
+    # All output is consolidated into a single dataset per network type (a FULL CSV file,
+    # ColumnStore or Aggregates), or a single database, as runs complete
     
     ### Finally, archive data ###
     print "Archiving data"
-    # Zip data files into single file
-    makeArchive(dirEntries(data_dir,True),data_dir+".zip")
+    # Zip data files into single file, leaving out files left partly written by an interrupted sweep
+    makeArchive([f for f in dirEntries(data_dir,True) if not f.endswith(".tmp")],data_dir+".zip")
+
+def paired_differences(values,baseline):
+    """Returns a RunningMean per family of the differences between its values and the
+    baseline family's values in the same runs. values is a dict of {run: value} dicts keyed
+    by family; runs missing from either family are skipped."""
+    differences={}
+    for family in values:
+        if family!=baseline:
+            runs=sorted(set(values[family]) & set(values[baseline]))
+            differences[family]=RunningMean()
+            differences[family].add_many([values[family][r]-values[baseline][r] for r in runs])
+    return differences
+
+def report_runs(num_runs,num_agents,master_seed=0,workers=None,target_width=None,common=False):
+    """Streams runs with iter_runs and prints each family's provision rate, and the number
+    of runs it took, as the family finishes. With common=True each family's difference
+    from the first family, paired run by run, is printed too."""
+    stats=dict((f,RunningMean()) for f,d in FAMILIES)
+    last_run=dict((f,-1) for f,d in FAMILIES)
+    values=dict((f,{}) for f,d in FAMILIES)
+    for family,run,summary in iter_runs(num_runs,num_agents,master_seed,workers,target_width=target_width,common=common):
+        stats[family].add(summary["threshold_met"])
+        last_run[family]=run
+        values[family][run]=summary["threshold_met"]
+    for family,d in FAMILIES:
+        print "%s: provision rate %.3f +/- %.3f over %d runs" % (d,stats[family].mean,stats[family].ci_width()/2,last_run[family]+1)
+    if common:
+        baseline=FAMILIES[0][0]
+        differences=paired_differences(values,baseline)
+        for family,d in FAMILIES[1:]:
+            print "%s - %s: paired difference %.3f +/- %.3f over %d runs" % (d,dict(FAMILIES)[baseline],
+                differences[family].mean,differences[family].ci_width()/2,differences[family].count)
+
+class TestEnsemble(unittest.TestCase):
+    """Test case for the parallel ensemble runner"""
+    
+    num_runs=3
+    num_agents=30
+    
+    def setUp(self):
+        """Create a scratch data directory"""
+        self.data_dir=tempfile.mkdtemp()
+        
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+        
+    def run_data(self,workers):
+        """Runs a small ensemble and returns the contents of every output file"""
+        data_dir=self.data_dir+"/"+str(workers)
+        make_data_dirs(data_dir)
+        run_ensemble(self.num_runs,self.num_agents,data_dir,master_seed=11,workers=workers)
+        return dict((f[len(data_dir):],open(f).read()) for f in dirEntries(data_dir,True,"csv"))
+        
+    def test_worker_count(self):
+        """Test that results are identical whatever the number of workers"""
+        serial=self.run_data(1)
+        # One file per run, and the FULL file of each family
+        self.assertEquals(len(serial),(self.num_runs+1)*len(FAMILIES))
+        self.assertEquals(serial,self.run_data(2))
+        
+    def test_file_md5(self):
+        """Test that files are hashed in chunks, whole or up to a prefix"""
+        path=self.data_dir+"/data.bin"
+        open(path,"wb").write("0123456789"*7)
+        self.assertEquals(file_md5(path,chunk_size=8).hexdigest(),hashlib.md5("0123456789"*7).hexdigest())
+        self.assertEquals(file_md5(path,25,chunk_size=8).hexdigest(),hashlib.md5(("0123456789"*7)[:25]).hexdigest())
+        self.assertEquals(file_record(path)["bytes"],70)
+        
+    def test_resume(self):
+        """Test that an interrupted sweep is resumed, rerunning only missing or corrupt
+        tasks, with the same output as an uninterrupted sweep"""
+        make_data_dirs(self.data_dir)
+        run_ensemble(self.num_runs,self.num_agents,self.data_dir,master_seed=11,workers=2)
+        files=dirEntries(self.data_dir,True,"csv")
+        expected=dict((f,open(f).read()) for f in files)
+        # The FULL files match a final pass over all run files
+        concat_runs(self.data_dir,self.num_runs,dict(FAMILIES).values())
+        self.assertEquals(expected,dict((f,open(f).read()) for f in files))
+        # Interrupt the sweep: a run file lost, one left partly written, a FULL file 
+        # partly consolidated, a task's record lost from the journal and a line torn
+        missing=run_path(self.data_dir,"uni",1)
+        corrupt=run_path(self.data_dir,"pl",2)
+        unrecorded=run_path(self.data_dir,"binom",2)
+        os.remove(missing)
+        open(corrupt,"w").write(expected[corrupt][:50])
+        full=self.data_dir+"/pareto/FULL_pareto.csv"
+        open(full,"w").write(expected[full][:100])
+        lines=open(self.data_dir+"/manifest.jsonl").readlines()
+        kept=[line for line in lines if json.loads(line).get("file")!=unrecorded]
+        self.assertEquals(len(kept),len(lines)-1)
+        open(self.data_dir+"/manifest.jsonl","w").writelines(kept+[lines[0][:10]])
+        inodes=dict((f,os.stat(f).st_ino) for f in files if os.path.exists(f))
+        run_ensemble(self.num_runs,self.num_agents,self.data_dir,master_seed=11,workers=1,resume=True)
+        self.assertEquals(expected,dict((f,open(f).read()) for f in files))
+        rerun=[f for f in inodes if "FULL" not in f and os.stat(f).st_ino!=inodes[f]]
+        self.assertEquals(sorted(rerun),sorted([corrupt,unrecorded]))
+        # A sweep with other parameters reruns everything
+        run_ensemble(self.num_runs,self.num_agents,self.data_dir,master_seed=12,workers=1,resume=True)
+        self.assertNotEquals(expected[corrupt],open(corrupt).read())
+        self.assertRaises(ValueError,run_ensemble,1,self.num_agents,self.data_dir,output="columns",resume=True)
+        
+    def test_resume_changed(self):
+        """Test that checkpoints of a sweep with other parameters, or of a FULL file that
+        no longer matches them, are never used"""
+        make_data_dirs(self.data_dir)
+        full=self.data_dir+"/binomial/FULL_binomial.csv"
+        journal=self.data_dir+"/manifest.jsonl"
+        run_ensemble(self.num_runs,self.num_agents,self.data_dir,master_seed=1,workers=1)
+        run_ensemble(self.num_runs,2*self.num_agents,self.data_dir,master_seed=1,workers=1,resume=True)
+        expected=open(full).read()
+        # Interrupted between consolidating binom's last run and checkpointing it
+        lines=open(journal).readlines()
+        last=max(i for i,line in enumerate(lines) if '"consolidated"' in line and '"binom"' in line)
+        open(journal,"w").writelines(lines[:last]+lines[last+1:])
+        run_ensemble(self.num_runs,2*self.num_agents,self.data_dir,master_seed=1,workers=1,resume=True)
+        self.assertEquals(expected,open(full).read())
+        # A FULL file changed in place, keeping its size, is consolidated again
+        open(full,"r+b").write("x")
+        run_ensemble(self.num_runs,2*self.num_agents,self.data_dir,master_seed=1,workers=1,resume=True)
+        self.assertEquals(expected,open(full).read())
+        
+    def test_columns(self):
+        """Test that columnar output matches the per-run CSV files"""
+        make_data_dirs(self.data_dir)
+        run_ensemble(self.num_runs,self.num_agents,self.data_dir,master_seed=11,workers=2,output="columns")
+        run_ensemble(self.num_runs,self.num_agents,self.data_dir,master_seed=11,workers=1)
+        for f,d in FAMILIES:
+            columns=load_columns(self.data_dir+"/"+d+"/FULL_"+d)
+            self.assertEquals(len(columns["run"]),self.num_runs*self.num_agents)
+            for r in xrange(self.num_runs):
+                rows=list(csv.DictReader(open(self.data_dir+"/"+d+"/"+str(r)+"_"+d+".csv")))
+                in_run=columns["run"]==r
+                for name in ("wealth","contrib","threshold"):
+                    self.assertEquals(map(float,[row[name] for row in rows]),list(columns[name][in_run]))
+                for name in ("disposition","type","num_neighbors","threshold_met"):
+                    self.assertEquals(map(int,[row[name] for row in rows]),list(columns[name][in_run]))
+        
+    def test_sqlite(self):
+        """Test that runs written by the workers to the result store match columnar output"""
+        make_data_dirs(self.data_dir)
+        run_ensemble(self.num_runs,self.num_agents,self.data_dir,master_seed=11,workers=2,output="columns")
+        # A repeated sweep replaces its runs rather than adding them again
+        for i in xrange(2):
+            run_ensemble(self.num_runs,self.num_agents,self.data_dir,master_seed=11,workers=2,output="sqlite")
+        store=SB_store.ResultStore(self.data_dir+"/results.db")
+        for f,d in FAMILIES:
+            columns=load_columns(self.data_dir+"/"+d+"/FULL_"+d)
+            runs=sorted(store.runs(family=f,population=self.num_agents),key=lambda r: r["run"])
+            self.assertEquals([r["run"] for r in runs],range(self.num_runs))
+            for r in runs:
+                in_run=columns["run"]==r["run"]
+                agents=store.agents(r["id"])
+                self.assertEquals(r["threshold_met"],columns["threshold_met"][in_run][0])
+                for name in ("wealth","contrib","num_neighbors","type"):
+                    self.assertTrue(np.array_equal(agents[name],columns[name][in_run]))
+            rate,count=store.provision_rate(family=f)
+            self.assertEquals(count,self.num_runs)
+        self.assertEquals(store.query("SELECT COUNT(*) FROM agents")[0][0],len(FAMILIES)*self.num_runs*self.num_agents)
+        store.close()
+        
+    def test_telemetry(self):
+        """Test that the phase timings of every run are aggregated"""
+        make_data_dirs(self.data_dir)
+        telemetry=run_ensemble(self.num_runs,self.num_agents,self.data_dir,workers=2)
+        phases=["contribs","evaluate","mnet","network","output","population"]
+        self.assertEquals(sorted(telemetry.keys()),sorted((f,p) for f,d in FAMILIES for p in phases))
+        self.assertTrue(all(seconds>=0 for seconds in telemetry.values()))
+        
+    def test_aggregates(self):
+        """Test that online aggregates match summaries of the full columnar data"""
+        make_data_dirs(self.data_dir)
+        run_ensemble(self.num_runs,self.num_agents,self.data_dir,master_seed=11,workers=2,output="columns")
+        run_ensemble(self.num_runs,self.num_agents,self.data_dir,master_seed=11,workers=2,output="aggregates")
+        for f,d in FAMILIES:
+            full=load_columns(self.data_dir+"/"+d+"/FULL_"+d)
+            agg=json.load(open(self.data_dir+"/"+d+"/aggregates.json"))
+            self.assertEquals(agg["num_runs"],self.num_runs)
+            self.assertEquals(agg["degree_hist"],np.bincount(full["num_neighbors"]).tolist())
+            contrib_hist=np.array(agg["contrib_hist"])
+            self.assertEquals(contrib_hist.sum(),self.num_runs*self.num_agents)
+            for t in xrange(5):
+                of_type=full["type"]==t
+                for met in (0,1):
+                    expected=np.histogram(full["contrib"][of_type & (full["threshold_met"]==met)],bins=10,range=(0,1))[0]
+                    self.assertEquals(contrib_hist[met,t].tolist(),expected.tolist())
+                wealth_hist=np.array(agg["type_wealth_hist"][t])
+                self.assertEquals(wealth_hist.tolist(),np.bincount((full["wealth"][of_type]//20).astype(int),minlength=len(wealth_hist)).tolist())
+                stats=agg["stats"]["contrib"][t]
+                self.assertEquals(stats["count"],of_type.sum())
+                self.assertAlmostEquals(stats["mean"],full["contrib"][of_type].mean())
+                self.assertAlmostEquals(stats["variance"],full["contrib"][of_type].var(ddof=1))
+            shown=(full["disposition"]>0) & (full["wealth"]<30)
+            self.assertEquals(np.array(agg["wealth_contrib_hist"]).sum(),shown.sum())
+            self.assertAlmostEquals(agg["provision"]["mean"],full["threshold_met"].mean())
+
+    def test_iter_runs(self):
+        """Test that streamed summaries match the runs, and do not depend on workers"""
+        serial=list(iter_runs(self.num_runs,self.num_agents,master_seed=11,workers=1))
+        self.assertEquals(serial,list(iter_runs(self.num_runs,self.num_agents,master_seed=11,workers=2)))
+        self.assertEquals(len(serial),self.num_runs*len(FAMILIES))
+        for family,run,summary in serial:
+            E=build_environment(family,run,self.num_agents,11)
+            self.assertEquals(summary["threshold_met"],int(E.good_provided()))
+            self.assertAlmostEquals(sum(summary["type_contribs"].values()),summary["total_contribs"])
+        
+    def test_adaptive(self):
+        """Test that a family stops once its confidence interval is narrow enough"""
+        runs=list(iter_runs(200,self.num_agents,workers=2,families=["pref"],target_width=.3,min_runs=10))
+        stat=RunningMean()
+        for family,run,summary in runs:
+            self.assertEquals(run,stat.count)
+            stat.add(summary["threshold_met"])
+        self.assertTrue(stat.ci_width()<.3 and len(runs)<200)
+        width=RunningMean()
+        for family,run,summary in runs[:-1]:
+            width.add(summary["threshold_met"])
+        self.assertTrue(len(runs)==10 or width.ci_width()>=.3)
+        
+    def test_common(self):
+        """Test that in common random numbers mode only the network varies within a run,
+        and that paired differences between families are less noisy"""
+        for run in xrange(2):
+            envs=[build_environment(f,run,self.num_agents,11,common=True) for f,d in FAMILIES]
+            for E in envs[1:]:
+                for name in SB.Population.ARRAYS:
+                    if name not in ("contrib","mnet"):
+                        self.assertTrue(np.array_equal(getattr(E.agents,name),getattr(envs[0].agents,name)))
+            self.assertFalse(np.array_equal(envs[0].agents.mnet,envs[1].agents.mnet))
+        self.assertFalse(np.array_equal(build_environment("uni",0,self.num_agents,11).agents.wealth,envs[0].agents.wealth))
+        widths=[]
+        for common in (False,True):
+            values=dict((f,{}) for f in ("binom","pl"))
+            for family,run,summary in iter_runs(40,self.num_agents,11,workers=1,families=["binom","pl"],common=common):
+                values[family][run]=summary["total_contribs"]
+            widths.append(paired_differences(values,"binom")["pl"].ci_width())
+        self.assertTrue(widths[1]<widths[0]/2)
+        
+    def test_binary_width(self):
+        """Test that a family always or never meeting the threshold does not stop at min_runs"""
+        stat=RunningMean()
+        stat.add_many([1]*30)
+        self.assertTrue(stat.binary and stat.ci_width()>.1)
+        stat.add(.5)
+        self.assertFalse(stat.binary)
+        for value in (0,1):
+            runs=list(iter_runs(200,self.num_agents,workers=1,families=["pref"],target_width=.1,
+                statistic=lambda summary,value=value: value,min_runs=10))
+            # The Wilson interval of n equal values has width z^2/(n+z^2)
+            self.assertEquals(len(runs),int(1.96**2/.1-1.96**2)+1)
+        
+    def test_task_seeds(self):
+        """Test that every task gets its own seed"""
+        seeds=set(tuple(task_seed(0,f[0],r)) for f in FAMILIES for r in xrange(10))
+        self.assertEquals(len(seeds),10*len(FAMILIES))
+
 
 if __name__ == '__main__':
-    main()
+    parser=OptionParser()
+    parser.add_option("-r","--runs",type="int",default=500,help="number of runs per network family")
+    parser.add_option("-a","--agents",type="int",default=150,help="number of agents per run")
+    parser.add_option("-s","--seed",type="int",default=0,help="master random seed")
+    parser.add_option("-w","--workers",type="int",default=None,help="number of worker processes (default one per CPU)")
+    parser.add_option("-o","--output",choices=["csv","columns","aggregates","sqlite"],default="csv",
+        help="output format: csv, columns, aggregates or sqlite")
+    parser.add_option("-p","--profile",action="store_true",default=False,help="print the time spent in each phase of the runs")
+    parser.add_option("-t","--target-width",type="float",default=None,
+        help="only print provision rates, stopping each family once its confidence interval is this narrow")
+    parser.add_option("-R","--resume",action="store_true",default=False,
+        help="resume an interrupted CSV sweep, skipping tasks already completed")
+    parser.add_option("-c","--common",action="store_true",default=False,
+        help="reuse each run's population across network families (common random numbers)")
+    (options,args)=parser.parse_args()
+    if options.target_width is not None:
+        report_runs(options.runs,options.agents,options.seed,options.workers,options.target_width,options.common)
+        sys.exit()
+    main(num_runs=options.runs,num_agents=options.agents,master_seed=options.seed,workers=options.workers,output=options.output,
+        profile=options.profile,common=options.common,resume=options.resume)
 
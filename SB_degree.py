@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+SB_degree.py
+
+Purpose:  Vectorized samplers of the degree sequences used by SB_data_gen, for one run
+          or a batch of runs at once.
+
+          Each sampler draws a (runs x n) array of real values in one call, rounds them
+          to degrees in [0,n] as nx.create_degree_sequence does, evens each row's sum by
+          moving one random agent's degree by one, and redraws only the rows that are
+          still not graphical, including every row with a degree of n. Sequences can be
+          passed straight to Environment(degree_seq=...), or a batch to BatchEnvironment.
+
+Author:   Drew Conway
+Email:    drew.conway@nyu.edu
+Date:     2010-07-27
+
+Copyright (c) 2010, under the Simplified BSD License.
+For more information on FreeBSD see: http://www.opensource.org/licenses/bsd-license.php
+All rights reserved.
+"""
+
+import unittest
+import networkx as nx
+import numpy as np
+import StateBuilding as SB
+
+
+def _make_even(degrees,rng):
+    """Moves one random agent's degree by one in every row with an odd degree sum, up
+    unless the agent has exactly the maximum degree n-1. A degree of n (or more) is moved
+    up, so its row is still rejected rather than brought into range."""
+    K,n=degrees.shape
+    odd=np.flatnonzero(degrees.sum(axis=1)%2)
+    agents=rng.randint(low=0,high=n,size=len(odd))
+    degrees[odd,agents]+=np.where(degrees[odd,agents]==n-1,-1,1)
+    return degrees
+
+def graphical_sequences(draw,num_agents,runs=None,rng=None,max_tries=50):
+    """Returns graphical degree sequences from draw(rng,shape), which returns an array of
+    real values of the given shape: one sequence, or a (runs x num_agents) array if runs
+    is given. As nx.create_degree_sequence, values are rounded and clipped to [0,n], so 
+    rows with a value beyond n-1 are redrawn, and NetworkXError is raised if a sequence
+    is not graphical after max_tries draws."""
+    if rng is None:
+        rng=np.random
+    shape_runs=1 if runs is None else runs
+    sequences=np.zeros((shape_runs,num_agents),dtype=int)
+    pending=np.arange(shape_runs)
+    for t in xrange(max_tries):
+        if len(pending)==0 or num_agents==0:
+            break
+        values=draw(rng,(len(pending),num_agents))
+        degrees=np.clip(np.round(values),0,num_agents).astype(int)
+        sequences[pending]=_make_even(degrees,rng)
+        pending=pending[~SB.graphical_rows(sequences[pending])]
+    if len(pending)>0 and num_agents>0:
+        raise nx.NetworkXError("Exceeded max (%d) attempts at a valid sequence." % max_tries)
+    return sequences[0] if runs is None else sequences
+
+def binomial_sequences(num_agents,runs=None,p=.5,rng=None):
+    """Degrees of a G(n,p) random graph, drawn as independent Binomial(n-1,p) degrees
+    rather than by building the graph"""
+    return graphical_sequences(lambda rng,shape: rng.binomial(max(num_agents-1,0),p,size=shape),num_agents,runs,rng)
+
+def uniform_sequences(num_agents,runs=None,rng=None):
+    """Degrees drawn uniformly from [0,n), as nx.utils.uniform_sequence"""
+    return graphical_sequences(lambda rng,shape: rng.uniform(0,num_agents,size=shape),num_agents,runs,rng)
+
+def pareto_sequences(num_agents,runs=None,exponent=1.0,rng=None):
+    """Degrees drawn from a Pareto distribution with minimum 1, as nx.utils.pareto_sequence"""
+    return graphical_sequences(lambda rng,shape: rng.pareto(exponent,size=shape)+1,num_agents,runs,rng)
+
+def powerlaw_sequences(num_agents,runs=None,exponent=2.0,rng=None):
+    """Degrees drawn from a power law, as nx.utils.powerlaw_sequence"""
+    return pareto_sequences(num_agents,runs,exponent-1,rng)
+
+# Sampler for each degree sequence family of SB_data_gen
+SAMPLERS={"binom":binomial_sequences,"uni":uniform_sequences,"par":pareto_sequences,"pl":powerlaw_sequences}
+
+
+class TestDegreeSequences(unittest.TestCase):
+    """Test case for the vectorized degree sequence samplers"""
+
+    num_agents=60
+    runs=40
+
+    def test_graphical(self):
+        """Test that every sampled sequence is graphical and fits an Environment"""
+        rng=np.random.RandomState(2)
+        for family,sampler in SAMPLERS.items():
+            batch=sampler(self.num_agents,self.runs,rng=rng)
+            self.assertEquals(batch.shape,(self.runs,self.num_agents))
+            for ds in batch.tolist():
+                self.assertTrue(nx.is_valid_degree_sequence(ds))
+            ds=sampler(self.num_agents,rng=rng)
+            self.assertEquals(ds.shape,(self.num_agents,))
+            self.assertEquals(SB.Environment(self.num_agents,degree_seq=ds).num_agents(),self.num_agents)
+
+    def test_distributions(self):
+        """Test that sampled degrees have the mean of the NX sequences they replace"""
+        rng=np.random.RandomState(5)
+        binom=binomial_sequences(self.num_agents,self.runs,rng=rng)
+        self.assertTrue(abs(binom.mean()-.5*(self.num_agents-1))<1)
+        uni=uniform_sequences(self.num_agents,self.runs,rng=rng)
+        self.assertTrue(abs(uni.mean()-.5*self.num_agents)<1)
+        # Pareto and power-law degrees have minimum 1
+        self.assertTrue((pareto_sequences(self.num_agents,self.runs,rng=rng)>=1).all())
+        self.assertTrue((powerlaw_sequences(self.num_agents,self.runs,rng=rng)>=1).all())
+        
+    def test_overflow(self):
+        """Test that rows with values beyond n-1 are redrawn, not clipped to n-1"""
+        draws=iter([[[2,2,4,2]],[[2,2,2,2]]])
+        ds=graphical_sequences(lambda rng,shape: np.array(next(draws),dtype=float),4,rng=np.random.RandomState(0))
+        self.assertEquals(list(ds),[2,2,2,2])
+        # The heavy tail rarely reaches n-1, as with nx.create_degree_sequence
+        batch=pareto_sequences(150,200,rng=np.random.RandomState(1))
+        self.assertTrue((batch==149).any(axis=1).mean()<.05)
+
+    def test_seeded(self):
+        """Test that seeded batches are reproducible"""
+        a=pareto_sequences(self.num_agents,3,rng=np.random.RandomState(1))
+        b=pareto_sequences(self.num_agents,3,rng=np.random.RandomState(1))
+        self.assertTrue((a==b).all())
+        # An even but never graphical draw
+        self.assertRaises(nx.NetworkXError,graphical_sequences,lambda rng,shape: np.tile([3,3,1,1],(shape[0],1)),4)
+
+
+if __name__ == '__main__':
+    unittest.main()
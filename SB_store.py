@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+SB_store.py
+
+Purpose:  Indexed store of simulation results in a single SQLite database, queried
+          without re-reading the per-run CSV files.
+
+          ResultStore class:    A runs table with one row per simulation run (family,
+                                run, population, m, threshold, total contributions and
+                                provision) and an agents table with one row per agent of
+                                each run, keyed by the run's id. Worker processes append
+                                runs concurrently, each through its own connection.
+
+Author:   Drew Conway
+Email:    drew.conway@nyu.edu
+Date:     2010-07-27
+
+Copyright (c) 2010, under the Simplified BSD License.
+For more information on FreeBSD see: http://www.opensource.org/licenses/bsd-license.php
+All rights reserved.
+"""
+
+import sqlite3
+import unittest
+import tempfile
+import shutil
+import multiprocessing
+import numpy as np
+import StateBuilding as SB
+
+# Columns of the runs table, after its integer id, and their SQL types
+RUN_COLUMNS=[("family","TEXT"),("run","INTEGER"),("population","INTEGER"),("m","REAL"),("state_wealth","REAL"),
+    ("threshold","REAL"),("total_contribs","REAL"),("threshold_met","INTEGER")]
+# Columns of the agents table, after the run id and agent id (see Environment.get_columns)
+AGENT_COLUMNS=[("wealth","REAL"),("disposition","INTEGER"),("type","INTEGER"),("num_neighbors","INTEGER"),
+    ("mnet","REAL"),("contrib","REAL")]
+
+SCHEMA=["CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, %s)" % ", ".join("%s %s" % c for c in RUN_COLUMNS),
+    "CREATE TABLE IF NOT EXISTS agents (run_id INTEGER NOT NULL REFERENCES runs(id), agent INTEGER NOT NULL, %s, "
+        "PRIMARY KEY (run_id, agent))" % ", ".join("%s %s" % c for c in AGENT_COLUMNS),
+    "CREATE UNIQUE INDEX IF NOT EXISTS runs_key ON runs (family, run, population, m)",
+    "CREATE INDEX IF NOT EXISTS runs_family ON runs (family, m)",
+    "CREATE INDEX IF NOT EXISTS runs_run ON runs (run)",
+    "CREATE INDEX IF NOT EXISTS runs_population ON runs (population, m)",
+    "CREATE INDEX IF NOT EXISTS runs_m ON runs (m)"]
+
+
+class ResultStore(object):
+    """Run and agent results in the SQLite database at path, created if needed
+
+    Parameters
+
+        path:           Path of the database file
+        timeout:        Seconds a writer waits for another process's write to finish
+
+    Each process should open its own ResultStore on the same path. The database is kept
+    in write-ahead-log mode, so queries run while workers write, and every run is added in
+    one transaction that takes the write lock up front, so concurrent appends are applied
+    whole and one at a time.
+    """
+    def __init__(self, path, timeout=60.0):
+        self.path=path
+        # Transactions are managed explicitly (see add_run)
+        self.connection=sqlite3.connect(path,timeout=timeout,isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+        finally:
+            self.connection.execute("COMMIT")
+
+    def add_run(self, env, family=None, run=None, agents=True):
+        """Adds a played Environment as a run of the given family and run number, with
+        one row per agent unless agents=False, and returns the run's id. A run with the
+        same family, run number, population and m replaces the one stored, so a re-run
+        sweep does not duplicate it; runs without a family or run number are always added."""
+        record=(family,run,env.num_agents(),env.m,env.get_state_wealth(),env.get_threshold(),
+            env.get_total_contribs(),int(env.good_provided()))
+        if agents:
+            columns=env.get_columns()
+            rows=zip(*[columns[name].tolist() for name,sql_type in AGENT_COLUMNS])
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            for (run_id,) in self.query("SELECT id FROM runs WHERE family=? AND run=? AND population=? AND m=?",record[:4]):
+                self.connection.execute("DELETE FROM agents WHERE run_id=?",(run_id,))
+                self.connection.execute("DELETE FROM runs WHERE id=?",(run_id,))
+            cursor=self.connection.execute("INSERT INTO runs (%s) VALUES (%s)" % (
+                ", ".join(c[0] for c in RUN_COLUMNS),", ".join("?"*len(RUN_COLUMNS))),record)
+            run_id=cursor.lastrowid
+            if agents:
+                self.connection.executemany("INSERT INTO agents VALUES (%s)" % ", ".join("?"*(len(AGENT_COLUMNS)+2)),
+                    ((run_id,a)+row for a,row in enumerate(rows)))
+        except:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+        return run_id
+
+    def _where(self, family=None, population=None, min_m=None, max_m=None, where=None, params=()):
+        """Returns the WHERE clause and parameters selecting runs"""
+        conditions=[]
+        values=[]
+        for condition,value in (("family=?",family),("population=?",population),("m>=?",min_m),("m<=?",max_m)):
+            if value is not None:
+                conditions.append(condition)
+                values.append(value)
+        if where is not None:
+            conditions.append("("+where+")")
+            values.extend(params)
+        return (" WHERE "+" AND ".join(conditions) if conditions else ""),values
+
+    def query(self, sql, params=()):
+        """Runs a SQL query and returns its rows as a list of tuples"""
+        return self.connection.execute(sql,params).fetchall()
+
+    def runs(self, family=None, population=None, min_m=None, max_m=None, where=None, params=()):
+        """Returns the selected runs as a list of dicts keyed by id and RUN_COLUMNS. Runs
+        are selected by family, population, a range of m, and any other SQL condition
+        on the runs table's columns, e.g. where="threshold>?", params=(x,)"""
+        clause,values=self._where(family,population,min_m,max_m,where,params)
+        names=["id"]+[c[0] for c in RUN_COLUMNS]
+        rows=self.query("SELECT %s FROM runs%s ORDER BY id" % (", ".join(names),clause),values)
+        return [dict(zip(names,row)) for row in rows]
+
+    def provision_rate(self, family=None, population=None, min_m=None, max_m=None, where=None, params=()):
+        """Returns the share of the selected runs (see runs) in which the public good was
+        provided, and the number of runs, computed inside the database"""
+        clause,values=self._where(family,population,min_m,max_m,where,params)
+        rate,count=self.query("SELECT AVG(threshold_met), COUNT(*) FROM runs"+clause,values)[0]
+        return rate,count
+
+    def agents(self, run_id):
+        """Returns the agent table of a run as a dict of arrays keyed by AGENT_COLUMNS"""
+        names=[c[0] for c in AGENT_COLUMNS]
+        rows=self.query("SELECT %s FROM agents WHERE run_id=? ORDER BY agent" % ", ".join(names),(run_id,))
+        return dict((name,np.array(column)) for name,column in zip(names,zip(*rows) if rows else [[]]*len(names)))
+
+    def close(self):
+        self.connection.close()
+
+
+def _add_runs(task):
+    """Adds seeded runs to the store at path from a worker process"""
+    path,family,seeds=task
+    store=ResultStore(path)
+    for seed in seeds:
+        store.add_run(SB.Environment(40,seed=seed),family,seed)
+    store.close()
+
+
+class TestResultStore(unittest.TestCase):
+    """Test case for the SQLite result store"""
+
+    def setUp(self):
+        """Create a scratch directory for the database"""
+        self.data_dir=tempfile.mkdtemp()
+        self.path=self.data_dir+"/results.db"
+
+    def tearDown(self):
+        """Remove the scratch directory and database"""
+        shutil.rmtree(self.data_dir)
+
+    def test_add_run(self):
+        """Test that runs and their agents are read back as added"""
+        store=ResultStore(self.path)
+        env=SB.Environment(50,seed=3)
+        run_id=store.add_run(env,"pref",0)
+        env.evaluate(.1)
+        env.get_data(store=store,family="pref",run=1)
+        runs=store.runs(family="pref")
+        self.assertEquals([r["run"] for r in runs],[0,1])
+        self.assertEquals(runs[1]["m"],.1)
+        self.assertEquals(runs[1]["threshold_met"],int(env.good_provided()))
+        self.assertEquals(store.runs(min_m=.05,max_m=.15),runs[1:])
+        agents=store.agents(run_id)
+        columns=env.get_columns()
+        for name,sql_type in AGENT_COLUMNS:
+            self.assertTrue(np.array_equal(agents[name],columns[name]))
+        self.assertEquals(len(store.agents(run_id+2)["wealth"]),0)
+        store.close()
+        # Reopening keeps the data
+        store=ResultStore(self.path)
+        self.assertEquals(store.provision_rate(where="threshold>?",params=(-1,)),
+            (np.mean([r["threshold_met"] for r in runs]),2))
+        self.assertEquals(store.provision_rate(family="pl"),(None,0))
+        # Adding a run again replaces it and its agents
+        store.add_run(SB.Environment(20,seed=4),"pref",0)
+        store.add_run(SB.Environment(50,seed=5),"pref",0)
+        self.assertEquals([r["run"] for r in store.runs(family="pref")],[1,0,0])
+        self.assertEquals(len(store.agents(run_id)["wealth"]),0)
+        self.assertEquals(store.query("SELECT COUNT(*) FROM agents")[0][0],120)
+        store.close()
+
+    def test_concurrent(self):
+        """Test that runs appended by several processes at once are all stored whole"""
+        ResultStore(self.path).close()
+        tasks=[(self.path,f,range(i*10,i*10+10)) for i,f in enumerate(["binom","uni","pl","par"])]
+        pool=multiprocessing.Pool(4)
+        pool.map(_add_runs,tasks)
+        pool.close()
+        pool.join()
+        store=ResultStore(self.path)
+        self.assertEquals(store.query("SELECT COUNT(*) FROM runs")[0][0],40)
+        self.assertEquals(store.query("SELECT COUNT(*) FROM agents")[0][0],40*40)
+        rate,count=store.provision_rate(family="pl")
+        self.assertEquals(count,10)
+        expected=np.mean([SB.Environment(40,seed=s).good_provided() for s in xrange(20,30)])
+        self.assertAlmostEquals(rate,expected)
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+SB_stream.py
+
+Purpose:  Out-of-core construction of the StateBuilding model, for populations whose
+          agents and network do not fit in memory.
+
+          StreamingEnvironment class:   Builds the population and network in chunks,
+                                        keeping all per-agent and per-tie arrays in
+                                        disk-backed memory maps, and plays the game with
+                                        peak memory set by the chunk size.
+
+Author:   Drew Conway
+Email:    drew.conway@nyu.edu
+Date:     2010-07-13
+
+Copyright (c) 2010, under the Simplified BSD License.
+For more information on FreeBSD see: http://www.opensource.org/licenses/bsd-license.php
+All rights reserved.
+"""
+
+import os
+import unittest
+import tempfile
+import shutil
+import networkx as nx
+import numpy as np
+import StateBuilding as SB
+
+
+def _graphical_counts(counts):
+    """Returns whether the degrees of a sequence with counts[d] agents of degree d, whose
+    sum is even and whose degrees are less than the number of agents, are those of some 
+    simple graph. The Erdos-Gallai inequalities only bind at the last of the agents of 
+    each degree in decreasing order, so they are checked in O(max degree)."""
+    counts=np.asarray(counts,dtype=np.int64)
+    values=np.arange(len(counts))
+    # Number of agents of degree at least d, and the sum of their degrees
+    at_least=np.cumsum(counts[::-1])[::-1]
+    sums=np.cumsum((values*counts)[::-1])[::-1]
+    cum_counts=np.cumsum(counts)
+    cum_sums=np.cumsum(values*counts)
+    present=np.flatnonzero(counts[1:])+1
+    k=at_least[present]
+    # Sum over the agents of lower degree of min(d,k): the degrees of at most k themselves,
+    # and k for each of the others
+    below=np.minimum(present-1,k)
+    rhs=k*(k-1)+cum_sums[below]+k*(cum_counts[present-1]-cum_counts[below])
+    return bool((sums[present]<=rhs).all())
+
+
+class _NeighborExtremes(object):
+    """Stands in for the Adjacency of a chunk of agents. Answers the neighbor min and
+    max wealth reductions used by the match rules from precomputed arrays."""
+    def __init__(self, wealth, nbr_min, nbr_max):
+        self.wealth=wealth
+        self.reduced={np.minimum: nbr_min, np.maximum: nbr_max}
+
+    def reduce_neighbors(self, ufunc, values, rows=None):
+        if values is not self.wealth or ufunc not in self.reduced:
+            raise ValueError("Streaming mode only has the min and max of neighbors' wealth")
+        if rows is None:
+            return np.array(self.reduced[ufunc])
+        return self.reduced[ufunc][rows]
+
+
+class _Chunk(object):
+    """A slice of a StreamingEnvironment's agents, in the form the contribution rules
+    expect of an Environment"""
+    def __init__(self, stream, start, stop):
+        arrays=dict((name,getattr(stream,name)[start:stop]) for name in SB.Population.ARRAYS)
+        self.agents=SB.Population.from_arrays(**arrays)
+        self.adjacency=_NeighborExtremes(self.agents.wealth,stream.nbr_min[start:stop],stream.nbr_max[start:stop])
+
+
+class StreamingEnvironment(object):
+    """The Environment's game for populations that do not fit in memory
+
+    Parameters
+
+        population:     Number of agents in the population
+        degree_seq:     Optional degree sequence (any array-like, e.g. a memory map) to
+                        configure agent network (default wealth-based preferential attachment)
+        m:              Optional fraction of total state wealth required to provide public good
+        seed:           Optional seed for the environment's own NumPy RandomState
+        chunk_size:     Number of agents (or ties) held in memory at once
+        workdir:        Optional directory for the disk-backed arrays (default a new
+                        temporary directory, removed by close())
+
+    Agent attributes, m_net, contributions and the network's ties are kept in memory maps
+    under workdir, and every pass over them reads chunk_size agents or ties at a time.
+    Only each agent's neighbor wealth sum, disposition-weighted sum, and min and max are
+    accumulated, so contribution rules may use no other reduction over neighbors.
+
+    With the same seed, the wealth attachment network, m_net and contributions are the
+    same as Environment's, whatever the chunk size. A degree sequence network is a
+    configuration model with self-loops and repeated ties dropped, whose stubs are
+    shuffled with a RandomState seeded by the population size.
+    """
+    def __init__(self, population,degree_seq=None,m=None,seed=None,chunk_size=2**20,workdir=None):
+        if type(population) is not int or population<=0:
+            raise ValueError("Model must have positive number of agents")
+        if type(chunk_size) is not int or chunk_size<=0:
+            raise ValueError("Chunk size must be a positive integer")
+        self.size=population
+        self.chunk_size=chunk_size
+        self.seed=seed
+        if seed is None:
+            self.rng=np.random
+        else:
+            self.rng=np.random.RandomState(seed)
+        self.owns_workdir=workdir is None
+        if workdir is None:
+            workdir=tempfile.mkdtemp(prefix="SB_stream")
+        elif not os.path.isdir(workdir):
+            os.mkdir(workdir)
+        self.workdir=workdir
+        self._draw_population()
+        # Total wealth as one pairwise sum over the memory map, exactly as Environment
+        self.state_wealth=float(self.wealth.sum())
+        m=SB._check_m(m)
+        # Neighbor sums and extremes, accumulated as ties are generated
+        self.y_net=self._array("y_net",float)
+        self.d_net=self._array("d_net",float)
+        self.nbr_min=self._array("nbr_min",float,np.inf)
+        self.nbr_max=self._array("nbr_max",float,-np.inf)
+        if degree_seq is None:
+            self._wealth_attachment()
+        else:
+            self._configuration_model(degree_seq)
+        for start,stop in self._chunks(self.size):
+            np.divide(self.d_net[start:stop],self.y_net[start:stop],out=self.mnet[start:stop],
+                where=self.y_net[start:stop]>0)
+            self.mnet[start:stop][self.y_net[start:stop]<=0]=0.0
+            SB.set_contribs(_Chunk(self,start,stop),[t for t in SB.CONTRIB_RULES if t not in SB.THRESHOLD_TYPES],None)
+        self.evaluate(m)
+
+    def _array(self, name, dtype, fill=0, length=None):
+        """Returns a new disk-backed array in workdir, filled with fill"""
+        if length is None:
+            length=self.size
+        if length==0:
+            return np.zeros(0,dtype=dtype)
+        array=np.memmap(os.path.join(self.workdir,name+".bin"),dtype=dtype,mode="w+",shape=(length,))
+        for start,stop in self._chunks(length):
+            array[start:stop]=fill
+        return array
+
+    def _chunks(self, length):
+        """Yields (start, stop) bounds of consecutive chunks of length items"""
+        for start in xrange(0,length,self.chunk_size):
+            yield start,min(start+self.chunk_size,length)
+
+    def _draw_population(self):
+        """Fills the agent attribute arrays chunk by chunk, in the same order of draws as
+        Population so that a seeded stream matches a seeded Environment"""
+        self.disposition=self._array("disposition",np.int8)
+        self.wealth=self._array("wealth",float)
+        self.type=self._array("type",np.int8)
+        self.draws=self._array("draws",float)
+        self.contrib=self._array("contrib",float,np.nan)
+        self.mnet=self._array("mnet",float,np.nan)
+        for start,stop in self._chunks(self.size):
+            self.disposition[start:stop]=self.rng.randint(low=0,high=2,size=stop-start)
+        for start,stop in self._chunks(self.size):
+            self.wealth[start:stop]=self.rng.pareto(3.,size=stop-start)
+        for start,stop in self._chunks(self.size):
+            self.type[start:stop]=self.rng.randint(low=0,high=5,size=stop-start)
+        for start,stop in self._chunks(self.size):
+            self.draws[start:stop]=self.rng.random_sample(stop-start)
+
+    def _accumulate(self, rows, cols):
+        """Adds the wealth of each col to the neighbor sums and extremes of its row.
+        Entries are added in order, as in Adjacency.sum_neighbors."""
+        wealth=self.wealth[cols]
+        np.add.at(self.y_net,rows,wealth)
+        np.add.at(self.d_net,rows,self.disposition[cols]*wealth)
+        np.minimum.at(self.nbr_min,rows,wealth)
+        np.maximum.at(self.nbr_max,rows,wealth)
+
+    def _wealth_attachment(self):
+        """Streams the ties of wealth_attachment_ties, with the same draws, one chunk of
+        targets at a time. Each target's ties lie in one chunk, so repeated pairs are found
+        chunk by chunk in the same order as over the whole network."""
+        n=self.size
+        counts=self._array("counts",int)
+        for start,stop in self._chunks(n):
+            tie_probs=np.minimum(self.wealth[start:stop]/self.state_wealth,1.0)
+            counts[start:stop]=self.rng.binomial(n-1,tie_probs) if n>1 else 0
+        # Edge offset of every chunk of targets
+        bounds=[]
+        offset=0
+        for start,stop in self._chunks(n):
+            bounds.append((start,stop,offset))
+            offset+=int(counts[start:stop].sum())
+        self.num_edges=offset
+        sources=self._array("sources",int,length=offset)
+        for start,stop in self._chunks(offset):
+            sources[start:stop]=self.rng.randint(low=0,high=n-1,size=stop-start)
+        def targets(start,stop):
+            return np.repeat(np.arange(start,stop),counts[start:stop])
+        while offset>0:
+            repeats=[]
+            for start,stop,first in bounds:
+                chunk_targets=targets(start,stop)
+                pair_keys=chunk_targets*(n-1)+sources[first:first+len(chunk_targets)]
+                order=np.argsort(pair_keys,kind="mergesort")
+                repeats.append(first+order[1:][pair_keys[order[1:]]==pair_keys[order[:-1]]])
+            repeats=np.concatenate(repeats)
+            if len(repeats)==0:
+                break
+            sources[repeats]=self.rng.randint(low=0,high=n-1,size=len(repeats))
+        # Skip over the target itself, then add each tie's entry to its source's
+        # neighbors before any entry to its target's neighbors, as the Adjacency stores them
+        for start,stop,first in bounds:
+            chunk_targets=targets(start,stop)
+            chunk_sources=np.array(sources[first:first+len(chunk_targets)])
+            chunk_sources[chunk_sources>=chunk_targets]+=1
+            sources[first:first+len(chunk_targets)]=chunk_sources
+            self._accumulate(chunk_sources,chunk_targets)
+        for start,stop,first in bounds:
+            chunk_targets=targets(start,stop)
+            self._accumulate(chunk_targets,np.array(sources[first:first+len(chunk_targets)]))
+
+    def _configuration_model(self, degree_seq):
+        """Streams a configuration model network: shuffles a disk-backed array of stubs,
+        pairs consecutive stubs, and drops self-loops and repeated ties by hashing the
+        pairs into buckets of about chunk_size pairs, which are deduplicated one at a time.
+        The sequence is validated as SB.is_graphical, from a histogram of its degrees."""
+        n=self.size
+        if len(degree_seq)!=n:
+            raise nx.NetworkXError('Invalid degree sequence')
+        total=0
+        counts=np.zeros(0,dtype=int)
+        for start,stop in self._chunks(n):
+            degrees=np.asarray(degree_seq[start:stop])
+            if degrees.ndim!=1 or not np.issubdtype(degrees.dtype,np.integer) or (degrees<0).any() or (degrees>=n).any():
+                raise nx.NetworkXError('Invalid degree sequence')
+            total+=int(degrees.sum())
+            chunk_counts=np.bincount(degrees,minlength=len(counts))
+            chunk_counts[:len(counts)]+=counts
+            counts=chunk_counts
+        if total%2 or not _graphical_counts(counts):
+            raise nx.NetworkXError('Invalid degree sequence')
+        stubs=self._array("stubs",int,length=total)
+        offset=0
+        for start,stop in self._chunks(n):
+            chunk_stubs=np.repeat(np.arange(start,stop),np.asarray(degree_seq[start:stop],dtype=int))
+            stubs[offset:offset+len(chunk_stubs)]=chunk_stubs
+            offset+=len(chunk_stubs)
+        if total>0:
+            # A plain ndarray view of the map is shuffled in place
+            np.random.RandomState(n).shuffle(stubs.view(np.ndarray))
+        num_pairs=total//2
+        num_buckets=max(1,-(-num_pairs//self.chunk_size))
+        buckets=[os.path.join(self.workdir,"bucket_%d.bin" % b) for b in xrange(num_buckets)]
+        for bucket in buckets:
+            open(bucket,"wb").close()
+        for start,stop in self._chunks(num_pairs):
+            first=np.array(stubs[2*start:2*stop:2])
+            second=np.array(stubs[2*start+1:2*stop:2])
+            loops=first==second
+            pair_keys=np.minimum(first,second)[~loops]*n+np.maximum(first,second)[~loops]
+            hashes=(pair_keys.astype(np.uint64)*np.uint64(11400714819323198485))%np.uint64(num_buckets)
+            order=np.argsort(hashes,kind="mergesort")
+            pair_keys=pair_keys[order]
+            splits=np.searchsorted(hashes[order],np.arange(1,num_buckets,dtype=np.uint64))
+            for bucket,keys in zip(buckets,np.split(pair_keys,splits)):
+                if len(keys)>0:
+                    with open(bucket,"ab") as f:
+                        keys.tofile(f)
+        self.num_edges=0
+        for bucket in buckets:
+            pair_keys=np.unique(np.fromfile(bucket,dtype=int))
+            os.remove(bucket)
+            self.num_edges+=len(pair_keys)
+            self._accumulate(pair_keys//n,pair_keys%n)
+            self._accumulate(pair_keys%n,pair_keys//n)
+
+    def evaluate(self,m=None):
+        """Plays the game with threshold m, one chunk of agents at a time, and returns
+        whether the public good is provided (see Environment.evaluate)"""
+        self.m=SB._check_m(m)
+        self.threshold=self.m*self.state_wealth
+        threshold_types=[t for t in SB.CONTRIB_RULES if t in SB.THRESHOLD_TYPES]
+        total=0.0
+        for start,stop in self._chunks(self.size):
+            SB.set_contribs(_Chunk(self,start,stop),threshold_types,self.threshold)
+            # Carry the running sum into the chunk, so contributions are summed in agent
+            # order exactly as Environment sums them
+            values=np.concatenate(([total],self.contrib[start:stop]*self.wealth[start:stop]))
+            total=np.cumsum(values)[-1]
+        self.total_contribs=float(total)
+        self.threshold_met=self.total_contribs>=self.threshold
+        return self.threshold_met
+
+    def get_population(self):
+        """Returns a Population view of the disk-backed agent arrays (without its network)"""
+        return SB.Population.from_arrays(**dict((name,getattr(self,name)) for name in SB.Population.ARRAYS))
+
+    def num_agents(self):
+        """Returns number of agents in environment"""
+        return self.size
+
+    def get_state_wealth(self):
+        """Returns total wealth of state"""
+        return self.state_wealth
+
+    def get_total_contribs(self):
+        """Returns total contributions from all agents"""
+        return self.total_contribs
+
+    def good_provided(self):
+        """Returns True if threshold is met"""
+        return self.threshold_met
+
+    def get_threshold(self):
+        """Returns threshold value"""
+        return self.threshold
+
+    def close(self):
+        """Releases the disk-backed arrays, removing workdir if it was created here"""
+        for name in ("disposition","wealth","type","draws","contrib","mnet","y_net","d_net","nbr_min","nbr_max"):
+            setattr(self,name,None)
+        if self.owns_workdir:
+            shutil.rmtree(self.workdir,ignore_errors=True)
+
+
+class TestStreamingEnvironment(unittest.TestCase):
+    """Test case for the out-of-core StreamingEnvironment"""
+    
+    def setUp(self):
+        """Keep track of the streams opened by each test"""
+        self.streams=[]
+
+    def tearDown(self):
+        """Close every stream, removing its workdir"""
+        for stream in self.streams:
+            stream.close()
+
+    def stream(self,*args,**kwargs):
+        """Returns a StreamingEnvironment closed after the test"""
+        stream=StreamingEnvironment(*args,**kwargs)
+        self.streams.append(stream)
+        return stream
+
+    def test_matches_environment(self):
+        """Test that a stream plays the same game as an in-memory Environment"""
+        for seed in xrange(5):
+            env=SB.Environment(150,seed=seed)
+            stream=self.stream(150,seed=seed,chunk_size=17)
+            self.assertEquals(stream.get_state_wealth(),env.get_state_wealth())
+            self.assertEquals(stream.num_edges,len(env.adjacency.indices)//2)
+            self.assertTrue(np.array_equal(stream.mnet,env.agents.mnet))
+            self.assertTrue(np.array_equal(stream.contrib,env.agents.contrib))
+            self.assertEquals(stream.get_total_contribs(),env.get_total_contribs())
+            self.assertEquals(stream.good_provided(),env.good_provided())
+            for m in (0.05,0.5):
+                self.assertEquals(stream.evaluate(m),env.evaluate(m))
+                self.assertEquals(stream.get_total_contribs(),env.get_total_contribs())
+
+    def test_chunk_size(self):
+        """Test that results do not depend on the chunk size"""
+        whole=self.stream(200,seed=3,chunk_size=1000)
+        for chunk_size in (1,64):
+            stream=self.stream(200,seed=3,chunk_size=chunk_size)
+            self.assertTrue(np.array_equal(stream.mnet,whole.mnet))
+            self.assertEquals(stream.get_total_contribs(),whole.get_total_contribs())
+
+    def test_degree_seq(self):
+        """Test the streamed configuration model against the in-memory network"""
+        ds=np.random.RandomState(0).randint(1,8,size=300)
+        ds[0]+=ds.sum()%2
+        stream=self.stream(300,degree_seq=ds,seed=1,chunk_size=50)
+        # Reference network, dropping self-loops and repeated ties from the same matching
+        stubs=np.repeat(np.arange(300),ds)
+        np.random.RandomState(300).shuffle(stubs)
+        pairs=stubs.reshape(-1,2)
+        pairs=pairs[pairs[:,0]!=pairs[:,1]]
+        pair_keys=np.unique(pairs.min(axis=1)*300+pairs.max(axis=1))
+        adjacency=SB.Adjacency(300,pair_keys//300,pair_keys%300)
+        self.assertEquals(stream.num_edges,len(pair_keys))
+        self.assertTrue(np.allclose(stream.mnet,SB.net_mnet(adjacency,stream.wealth,stream.disposition)))
+        self.assertTrue(np.array_equal(stream.nbr_max>0,adjacency.degree()>0))
+        # An in-memory Environment builds the same network from the same matching
+        env=SB.Environment(300,degree_seq=ds,seed=1)
+        self.assertTrue(np.array_equal(env.adjacency.degree(),adjacency.degree()))
+        self.assertTrue(np.allclose(stream.mnet,env.agents.mnet))
+        whole=self.stream(300,degree_seq=ds,seed=1,chunk_size=10000)
+        self.assertAlmostEquals(stream.get_total_contribs(),whole.get_total_contribs())
+        self.assertRaises(nx.NetworkXError,StreamingEnvironment,300,ds[1:])
+        ds[0]+=1
+        self.assertRaises(nx.NetworkXError,StreamingEnvironment,300,ds)
+        # Sequences with an even sum and degrees below n that no simple graph has, and floats
+        self.assertRaises(nx.NetworkXError,StreamingEnvironment,4,[3,3,1,1])
+        self.assertRaises(nx.NetworkXError,StreamingEnvironment,3,[2.,2.,2.])
+
+    def test_graphical_counts(self):
+        """Test the degree histogram check against SB.is_graphical"""
+        rng=np.random.RandomState(0)
+        for i in xrange(500):
+            n=rng.randint(1,12)
+            ds=rng.randint(0,n,size=n)
+            if ds.sum()%2==0:
+                self.assertEquals(_graphical_counts(np.bincount(ds)),SB.is_graphical(ds))
+
+    def test_workdir(self):
+        """Test that a given workdir holds the arrays and is kept on close"""
+        workdir=tempfile.mkdtemp()
+        try:
+            stream=StreamingEnvironment(50,seed=0,chunk_size=8,workdir=workdir+"/stream")
+            self.assertTrue(os.path.exists(workdir+"/stream/wealth.bin"))
+            population=stream.get_population()
+            self.assertEquals(len(population),50)
+            self.assertEquals(population[3].get_wealth(),stream.wealth[3])
+            stream.close()
+            self.assertTrue(os.path.exists(workdir+"/stream"))
+        finally:
+            shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
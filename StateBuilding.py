@@ -5,15 +5,36 @@ StateBuilding.py
 
 Purpose:    Code in support of "Network, collective action, and state building"
             
-            Code contains two classes: Agent and Environment.
+            Code contains eight classes: Agent, Population, Adjacency, NetworkCache,
+            Environment, BatchEnvironment, ProvisionCurve and ContributionDynamics.
             
             Agent class:        Agent object for computational model described in above paper.
                                 Contains fuctionality for forming agent networks,
+                                
+            Population class:   Array-backed store of agent attributes; agents are
+                                lightweight views onto a row of the store.
+                                
+            Adjacency class:    Compressed sparse row store of the agents' social network.
+            
+            NetworkCache class: Bounded LRU cache of degree sequence networks, in memory and
+                                optionally on disk, so each is built once.
                             
             Environment class:  Class object to contain agents, and object in which the 
                                 computational model is run.  Contains functionality
                                 for creating agent networks, adjudicating controbution level,
                                 and outputting data from runs.
+                                
+            BatchEnvironment:   Many replicate Environments of the same size and network family,
+                                simulated at once as stacked arrays.
+                                
+            ProvisionCurve:     Total contributions of an Environment as a function of the
+                                threshold m, and the critical thresholds at which provision
+                                of the public good flips, without re-running the game.
+                                
+            ContributionDynamics:
+                                Multi-round contribution dynamics of an Environment, in
+                                which agents respond to their neighbors' contributions in
+                                the previous round until none changes.
 
 Author:     Drew Conway
 Email:      drew.conway@nyu.edu
@@ -27,9 +48,276 @@ All rights reserved.
 import sys
 import os
 import unittest
+import tempfile
+import shutil
 import networkx as nx
-from numpy.random import randint,uniform,pareto,random
+import numpy as np
+from numpy.random import uniform,pareto,random
 import csv
+import json
+import time
+import hashlib
+import collections
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where peak memory is not recorded
+    resource=None
+
+
+def wealth_attachment_ties(wealth,state_wealth=None,rng=None,block_size=None):
+    """Returns a tuple of (source, target) arrays for a wealth-based 
+    preferential attachment network.
+    
+    Every ordered pair (i,j), i!=j, is tied with probability wealth[j]/state_wealth.
+    Rather than testing all n^2 pairs, ties are sampled in bulk per target agent:
+    the number of agents tying to j is drawn as Binomial(n-1,p_j), and those 
+    agents are a uniform sample (without replacement) of the other n-1 agents.
+    This gives the same tie distribution as the pairwise loop in O(n+E) time.
+    Random draws come from rng, a NumPy RandomState (default the global state).
+    
+    If block_size is given, agents are split into consecutive blocks of that size
+    which are separate networks (e.g. replicates), with ties only within a block and 
+    state_wealth the block's total wealth (optionally an array with one per block).
+    """
+    if rng is None:
+        rng=np.random
+    wealth=np.asarray(wealth,dtype=float)
+    if block_size is None:
+        block_size=len(wealth)
+    if block_size<2:
+        return np.zeros(0,dtype=int),np.zeros(0,dtype=int)
+    if len(wealth)%block_size:
+        raise ValueError("Number of agents must be a multiple of block_size")
+    if state_wealth is None:
+        state_wealth=wealth.reshape(-1,block_size).sum(axis=1)
+    tie_probs=np.minimum(wealth.reshape(-1,block_size)/np.reshape(state_wealth,(-1,1)),1.0).ravel()
+    targets=np.repeat(np.arange(len(wealth)),rng.binomial(block_size-1,tie_probs))
+    # Draw sources from the n-1 other agents of the target's block, then redraw any 
+    # source that was drawn twice for the same target until every pair is distinct
+    sources=rng.randint(low=0,high=block_size-1,size=len(targets))
+    while len(targets)>0:
+        pair_keys=targets*(block_size-1)+sources
+        order=np.argsort(pair_keys,kind="mergesort")
+        repeats=order[1:][pair_keys[order[1:]]==pair_keys[order[:-1]]]
+        if len(repeats)==0:
+            break
+        sources[repeats]=rng.randint(low=0,high=block_size-1,size=len(repeats))
+    # Skip over the target itself so that no agent ties to itself
+    block_start=targets-targets%block_size
+    sources[sources>=targets-block_start]+=1
+    return sources+block_start,targets
+    
+    
+def graphical_rows(degrees):
+    """Returns a boolean array of whether each row of a (K x n) array of integer degrees
+    is the degree sequence of some simple graph. The Erdos-Gallai inequalities are checked
+    for every row and every k at once, in O(K n log n)."""
+    degrees=np.asarray(degrees,dtype=np.int64)
+    K,n=degrees.shape
+    valid=((degrees>=0) & (degrees<n)).all(axis=1) & (degrees.sum(axis=1)%2==0)
+    if n==0:
+        return valid
+    clipped=np.clip(degrees,0,n)
+    descending=-np.sort(-clipped,axis=1)
+    rows=np.arange(K).reshape(-1,1)
+    # Number of degrees of at least k in each row, for k=1..n
+    counts=np.bincount((rows*(n+1)+clipped).ravel(),minlength=K*(n+1)).reshape(K,n+1)
+    at_least=np.cumsum(counts[:,::-1],axis=1)[:,::-1][:,1:]
+    # Sums of each row's degrees from each position on
+    suffix_sums=np.hstack((np.cumsum(descending[:,::-1],axis=1)[:,::-1],np.zeros((K,1),dtype=np.int64)))
+    # Sum over i>k of min(d_i,k): k for each of the degrees of at least k beyond position k,
+    # and the degrees themselves for the rest
+    k=np.arange(1,n+1)
+    rhs=k*(k-1)+k*np.maximum(at_least-k,0)+suffix_sums[rows,np.maximum(k,at_least)]
+    return valid & (np.cumsum(descending,axis=1)<=rhs).all(axis=1)
+    
+    
+def is_graphical(degree_seq):
+    """Returns whether degree_seq is a valid sequence of integer degrees of some simple 
+    graph, as nx.is_valid_degree_sequence, but without Havel-Hakimi reduction (see 
+    graphical_rows)"""
+    degrees=np.asarray(degree_seq)
+    if len(degrees)==0:
+        return True
+    if degrees.ndim!=1 or not np.issubdtype(degrees.dtype,np.integer):
+        return False
+    return bool(graphical_rows(degrees.reshape(1,-1))[0])
+    
+    
+def configuration_model_ties(degree_seq):
+    """Returns a tuple of (source, target) arrays for a random network with the given
+    degree sequence, raising NetworkXError if the sequence is not valid.
+    
+    Stubs (each agent repeated degree times) are shuffled in one pass and consecutive 
+    stubs paired, as in the NX configuration model. Self-loops and repeated ties are 
+    dropped, so each tie appears once with source<target, and agents may end up with a
+    lower degree than requested. For consistency, the random seed is always set to the 
+    number of agents in the network.
+    """
+    if not is_graphical(degree_seq):
+        raise nx.NetworkXError('Invalid degree sequence')
+    return _pair_stubs(degree_seq)
+    
+def _pair_stubs(degree_seq):
+    """Returns the ties of configuration_model_ties for an already validated sequence"""
+    n=len(degree_seq)
+    stubs=np.repeat(np.arange(n),np.asarray(degree_seq,dtype=int))
+    np.random.RandomState(n).shuffle(stubs)
+    pairs=stubs.reshape(-1,2)
+    pairs=pairs[pairs[:,0]!=pairs[:,1]]
+    pair_keys=np.unique(pairs.min(axis=1)*n+pairs.max(axis=1))
+    return pair_keys//n,pair_keys%n
+    
+    
+class NetworkCache(object):
+    """Bounded LRU cache of built networks
+    
+    Parameters
+    
+        max_entries:    Maximum number of networks kept in memory
+        max_bytes:      Maximum total bytes of the networks' CSR arrays kept in memory
+        path:           Optional directory where networks are also kept on disk, and
+                        shared by every process using it
+        max_disk_bytes: Optional maximum total bytes of the networks kept on disk
+    
+    A degree sequence network depends only on the sequence and the number of agents
+    (see configuration_model_ties), so it is keyed by a hash of the sequence, the 
+    population and the generator, and built once. The least recently used networks are
+    evicted once either limit is exceeded, and the oldest files once the disk limit is.
+    Cached CSR arrays are read-only and shared by every Adjacency returned for a key;
+    changing an Adjacency's ties replaces its arrays rather than writing to them. The
+    hits and misses counters count lookups served from memory or disk, and those not.
+    """
+    def __init__(self, max_entries=32, max_bytes=2**26, path=None, max_disk_bytes=None):
+        self.max_entries=max_entries
+        self.max_bytes=max_bytes
+        self.path=path
+        self.max_disk_bytes=max_disk_bytes
+        if path is not None and not os.path.isdir(path):
+            os.mkdir(path)
+        self.clear()
+        
+    def clear(self):
+        """Drops the networks kept in memory, and resets the counters"""
+        self.entries=collections.OrderedDict()
+        self.nbytes=0
+        self.hits=0
+        self.misses=0
+        self.evictions=0
+        
+    def key(self, degree_seq, population, generator="configuration_model"):
+        """Returns the key of a network"""
+        digest=hashlib.sha1(np.ascontiguousarray(degree_seq,dtype=np.int64).tostring()).hexdigest()
+        return (digest,population,generator)
+        
+    def _file(self, key):
+        return self.path+"/%s_%d_%s.npz" % key
+        
+    def get(self, key):
+        """Returns an Adjacency of the network with the given key, or None if it is not cached"""
+        if key in self.entries:
+            self.hits+=1
+            indptr,indices=self.entries.pop(key)
+            self.entries[key]=(indptr,indices)
+            return Adjacency.from_csr(indptr,indices)
+        if self.path is not None and os.path.exists(self._file(key)):
+            arrays=np.load(self._file(key))
+            indptr,indices=arrays["indptr"],arrays["indices"]
+            arrays.close()
+            self.hits+=1
+            self._store(key,indptr,indices)
+            return Adjacency.from_csr(indptr,indices)
+        self.misses+=1
+        return None
+        
+    def put(self, key, adjacency):
+        """Caches the network of an Adjacency under the given key"""
+        if key in self.entries:
+            return
+        self._store(key,adjacency.indptr,adjacency.indices)
+        if self.path is not None and not os.path.exists(self._file(key)):
+            # Written under a temporary name and renamed, so other processes never load a partial file
+            tmp=self.path+"/%d.tmp.npz" % os.getpid()
+            np.savez(tmp,indptr=adjacency.indptr,indices=adjacency.indices)
+            os.rename(tmp,self._file(key))
+            if self.max_disk_bytes is not None:
+                files=sorted((os.path.getmtime(f),os.path.getsize(f),f) for f in 
+                    (self.path+"/"+name for name in os.listdir(self.path) if name.endswith(".npz") and ".tmp" not in name))
+                total=sum(size for mtime,size,f in files)
+                for mtime,size,f in files:
+                    if total<=self.max_disk_bytes:
+                        break
+                    os.remove(f)
+                    total-=size
+        
+    def _store(self, key, indptr, indices):
+        """Keeps read-only CSR arrays in memory, evicting the least recently used networks"""
+        nbytes=indptr.nbytes+indices.nbytes
+        if nbytes>self.max_bytes:
+            return
+        indptr.flags.writeable=False
+        indices.flags.writeable=False
+        self.entries[key]=(indptr,indices)
+        self.nbytes+=nbytes
+        while len(self.entries)>self.max_entries or self.nbytes>self.max_bytes:
+            indptr,indices=self.entries.popitem(last=False)[1]
+            self.nbytes-=indptr.nbytes+indices.nbytes
+            self.evictions+=1
+            
+    def stats(self):
+        """Returns the cache's counters, and the number and bytes of networks in memory"""
+        return {"hits":self.hits,"misses":self.misses,"evictions":self.evictions,"entries":len(self.entries),"bytes":self.nbytes}
+        
+# Cache of degree sequence networks used by Environment by default
+NETWORK_CACHE=NetworkCache()
+    
+    
+def _check_m(m):
+    """Returns the value of m, or the default m if None, after checking it is \in[0,1]"""
+    if m is None:
+        return .25
+    if m>=0 and m<=1:
+        return m
+    raise ValueError("Value for m must be between 0 and 1")
+    
+    
+def _peak_rss():
+    """Returns the peak resident set size of this process in bytes, or None if unknown"""
+    if resource is None:
+        return None
+    rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on OS X, and kB on Linux
+    return rss if sys.platform=="darwin" else rss*1024
+
+
+def _phase_start():
+    """Returns the wall-clock time and peak memory at the start of a phase"""
+    return time.time(),_peak_rss()
+
+
+def _record_phase(env,phase,start,nbytes=0):
+    """Records the wall-clock time and peak memory growth since start (see _phase_start),
+    and the bytes of the result arrays a phase of env left in the model, in env.timings,
+    env.peak_rss_growth and env.result_bytes, and passes them to env.hook if set"""
+    start_time,start_rss=start
+    seconds=time.time()-start_time
+    rss=_peak_rss()
+    env.timings[phase]=seconds
+    env.peak_rss_growth[phase]=None if rss is None else rss-start_rss
+    env.result_bytes[phase]=nbytes
+    if env.hook is not None:
+        env.hook(env,phase,seconds,nbytes)
+    
+    
+def net_mnet(adjacency,wealth,disposition):
+    """Returns every agent's m_net parameter, the disposition-weighted share of wealth
+    among its neighbors, as two sparse matrix-vector products (0 for isolated agents)"""
+    y_net=adjacency.sum_neighbors(wealth)
+    d_net=adjacency.sum_neighbors(disposition*wealth)
+    mnet=np.zeros(len(y_net))
+    np.divide(d_net,y_net,out=mnet,where=y_net>0)
+    return mnet
 
 
 class Agent(object):
@@ -38,87 +326,88 @@ class Agent(object):
     Parameters
     
         agent_id:       Unique integer identifier for each agent
+        population:     Optional Population store holding the agent's attributes. If
+                        given, the agent is a view onto row agent_id of the store;
+                        otherwise the agent keeps its attributes in a population of one.
     
     """
-    def __init__(self, agent_id,agent_type=None):
-        # First two agent parameters are exogenous primitives 
-        self.disposition=randint(low=0,high=2)  # Prior disposition to contribuiting 
-        self.wealth=pareto(3.)      # Level of wealth
-        # Next, endogenously generated variables
-        # Set agent type
+    __slots__=("my_id","population","row")
+    
+    def __init__(self, agent_id,agent_type=None,population=None):
         if type(agent_id) is not int:
             raise ValueError("Agent IDs must be integers")
         else:
             self.my_id=agent_id     # Agent identifier
-        self.adj_list=list()        # Agent's ego-network (adjacency network)
-        # Set agent type, from one of five possible type:
-        #   0 - Altruistic: Always sets c=.5(wealth)
-        #   1 - Community:  Sets c=m' such that m'+m_net=w, given m_net
-        #   2 - Min-match:  Sets c=min(m') for all of agent's neighbors
-        #   3 - Max-match:  Sets c=max(m') for all of agent's neighbors
-        #   4 - Miserly:    Sets c=\epsilon
-        if agent_type is None:
-            self.type=randint(low=0,high=5)
+        if agent_type is not None:
+            if not(type(agent_type)is int and agent_type in CONTRIB_RULES):
+                raise ValueError("Agent type must be a registered int type, by default between 0 and 4")
+        if population is None:
+            # Exogenous primitives, agent type and placeholders are drawn by the store
+            population=Population(1,agent_types=None if agent_type is None else [agent_type])
+            self.row=0
         else:
-            if type(agent_type)is int and agent_type>=0 and agent_type<5:
-                self.type=agent_type
-            else:
-                raise ValueError("Agent type must be an int between 0 and 4")
-        # Finally, place holder for level of contribution and m_net
-        self.contrib=None
-        self.mnet=None
+            self.row=agent_id
+            if agent_type is not None:
+                population.type[self.row]=agent_type
+        self.population=population
     
     def make_tie(self, tie_agent):
         """Add an agent to adjacency list"""
-        self.adj_list.append(tie_agent.get_id())
+        self.population.adjacency.add_ties([self.row],[tie_agent.get_id()])
         
     def get_id(self):
         """Returns agent identification"""
         return self.my_id
         
     def get_neighbors(self):
-        """Returns a list of agent's neighbors"""
-        return self.adj_list
+        """Returns an array of agent's neighbors (a view into the adjacency store)"""
+        return self.population.adjacency.neighbors(self.row)
         
     def get_egonet(self, as_graph=False):
         """Returns agents ego network, either as
         an NX edgelist list, or a NX Graph object
         """
         if as_graph:
-            return nx.Graph(data=zip([(self.my_id) for i in self.adj_list],self.adj_list))
+            # Cached by the adjacency store until its ties change
+            egonets=self.population.adjacency.egonets
+            if (self.row,self.my_id) not in egonets:
+                egonets[(self.row,self.my_id)]=nx.Graph(data=zip([(self.my_id) for i in self.get_neighbors()],self.get_neighbors()))
+            return egonets[(self.row,self.my_id)]
         else:
             return zip([self.get_id() for n in self.get_neighbors()],self.get_neighbors())
         
     def get_disposition(self):
         """Returns an agent's disposition to support"""
-        return self.disposition
+        return int(self.population.disposition[self.row])
         
     def get_wealth(self):
         """Returns an agent's exogenous wealth"""
-        return self.wealth
+        return float(self.population.wealth[self.row])
         
     def set_contrib(self,contrib_level):
         """Sets the agent's c parameter"""
         if contrib_level>=0 and contrib_level <=1:
-            self.contrib=contrib_level
+            self.population.contrib[self.row]=contrib_level
         else:
             raise ValueError("Contribution level must be \in[0,1]")
             
     def get_contrib(self):
         """Returns agent's c parameter"""
-        return self.contrib
+        contrib=self.population.contrib[self.row]
+        return None if np.isnan(contrib) else float(contrib)
         
     def get_type(self):
         """Returns agent's type parameter"""
-        return self.type
+        return int(self.population.type[self.row])
         
     def set_mnet(self,mnet):
         """Sets the agents m_net parameter"""
-        self.mnet=mnet
+        self.population.mnet[self.row]=mnet
         
     def get_mnet(self):
         """Returns agent's mnet parameter"""
-        return self.mnet
+        mnet=self.population.mnet[self.row]
+        return None if np.isnan(mnet) else float(mnet)
         
     def info(self):
         """Print agent parameter values to STDOUT"""
@@ -130,6 +419,360 @@ class Agent(object):
         print("Contrib: "+str(self.get_contrib()))
         
         
+def _segments(starts,counts):
+    """Returns the positions of consecutive runs of counts[i] entries from starts[i]"""
+    offsets=np.cumsum(counts)-counts
+    return np.repeat(starts-offsets,counts)+np.arange(counts.sum())
+
+
+class Adjacency(object):
+    """Compressed sparse row (CSR) store of the agents' social network
+    
+    Parameters
+    
+        size:           Number of agents (rows) in the network
+        sources:        Optional array of tie sources
+        targets:        Optional array of tie targets
+        
+    Ties are symmetric: each (source, target) pair adds target to the source's 
+    neighbors and source to the target's neighbors. The neighbors of agent i are 
+    indices[indptr[i]:indptr[i+1]], and repeated ties are kept as repeated entries.
+    
+    Changing ties only rewrites the changed rows, which are kept apart from the CSR
+    arrays until indptr or indices is next read, and are then merged in one pass. 
+    neighbors, neighbors_of, degree and sum_neighbors or reduce_neighbors over given 
+    rows read the changed rows directly, without merging.
+    
+    The version counter is incremented whenever ties change. Derived views (the 
+    undirected edge list and ego networks) are cached until then, and degrees are kept
+    current. All are shared, so they should not be modified.
+    """
+    def __init__(self, size, sources=None, targets=None):
+        self.size=size
+        self.version=0
+        self._pending={}
+        if sources is None:
+            sources=targets=np.zeros(0,dtype=int)
+        sources=np.asarray(sources,dtype=int)
+        targets=np.asarray(targets,dtype=int)
+        self._build(np.concatenate((sources,targets)),np.concatenate((targets,sources)))
+        
+    def _build(self, rows, cols):
+        """Sort (row, col) entries into indptr/indices arrays"""
+        order=np.argsort(rows,kind="mergesort")
+        self._indices=cols[order]
+        self._indptr=np.zeros(self.size+1,dtype=int)
+        np.cumsum(np.bincount(rows,minlength=self.size),out=self._indptr[1:])
+        self._reset_views()
+        
+    def _reset_views(self):
+        """Marks the ties as changed, dropping all cached views"""
+        self._changed()
+        self._degree=None
+        
+    def _changed(self):
+        """Marks the ties as changed, dropping the cached views other than degrees"""
+        self.version+=1
+        self._edges=None
+        self.egonets={}
+        
+    @property
+    def indptr(self):
+        """Offsets of each row's entries in indices"""
+        self._merge()
+        return self._indptr
+        
+    @property
+    def indices(self):
+        """Neighbor entries of all rows, row by row"""
+        self._merge()
+        return self._indices
+        
+    @classmethod
+    def from_csr(cls, indptr, indices):
+        """Returns an Adjacency using existing (e.g. memory-mapped) indptr/indices arrays"""
+        adjacency=cls.__new__(cls)
+        adjacency.size=len(indptr)-1
+        adjacency.version=0
+        adjacency._pending={}
+        adjacency._indptr=indptr
+        adjacency._indices=indices
+        adjacency._reset_views()
+        return adjacency
+        
+    def add_ties(self, sources, targets):
+        """Add directed entries to the network, i.e. each target to the end of its source's 
+        neighbors, in time proportional to the sources' degrees"""
+        for row,added in self._by_row(sources,targets):
+            self._edit(row,np.concatenate((self.neighbors(row),added)))
+        self._changed()
+        
+    def remove_ties(self, sources, targets):
+        """Remove directed entries from the network, i.e. every entry of each target from
+        its source's neighbors, in time proportional to the sources' degrees"""
+        for row,removed in self._by_row(sources,targets):
+            neighbors=self.neighbors(row)
+            self._edit(row,neighbors[~np.in1d(neighbors,removed)])
+        self._changed()
+        
+    def _by_row(self, sources, targets):
+        """Returns (source, targets) pairs grouping the targets of each source, in order"""
+        sources=np.asarray(sources,dtype=int)
+        targets=np.asarray(targets,dtype=int)
+        order=np.argsort(sources,kind="mergesort")
+        rows,starts=np.unique(sources[order],return_index=True)
+        return zip(rows.tolist(),np.split(targets[order],starts[1:]))
+        
+    def _edit(self, row, neighbors):
+        """Replaces the neighbors of a row, keeping it apart from the CSR arrays"""
+        self.degree()[row]=len(neighbors)
+        self._pending[row]=neighbors.astype(self._indices.dtype)
+        
+    def _merge(self):
+        """Rewrites indptr/indices with the changed rows, in one pass over the network"""
+        if not self._pending:
+            return
+        degree=self.degree()
+        indptr=np.zeros(self.size+1,dtype=self._indptr.dtype)
+        np.cumsum(degree,out=indptr[1:])
+        indices=np.empty(indptr[-1],dtype=self._indices.dtype)
+        kept=np.ones(self.size,dtype=bool)
+        kept[self._pending.keys()]=False
+        rows=np.flatnonzero(kept)
+        counts,positions=self._entries(rows)
+        indices[_segments(indptr[rows],counts)]=self._indices[positions]
+        for row,neighbors in self._pending.iteritems():
+            indices[indptr[row]:indptr[row+1]]=neighbors
+        self._indptr,self._indices=indptr,indices
+        self._pending={}
+        
+    def _entries(self, rows):
+        """Returns the number of entries in indices of each of the given rows, and the 
+        positions of all of their entries, row by row, ignoring changed rows"""
+        rows=np.asarray(rows,dtype=int)
+        starts=self._indptr[rows]
+        counts=self._indptr[rows+1]-starts
+        return counts,_segments(starts,counts)
+        
+    def neighbors(self, row):
+        """Returns the neighbors of a row as a zero-copy slice of indices, or the row's
+        own array if its ties changed since indices was last read"""
+        if row in self._pending:
+            return self._pending[row]
+        return self._indices[self._indptr[row]:self._indptr[row+1]]
+        
+    def neighbors_of(self, rows):
+        """Returns the number of neighbor entries of each of the given rows, and all of
+        their neighbors, row by row, as one array"""
+        rows=np.asarray(rows,dtype=int)
+        if not self._pending:
+            counts,positions=self._entries(rows)
+            return counts,self._indices[positions]
+        counts=self.degree()[rows]
+        changed=np.in1d(rows,self._pending.keys())
+        offsets=np.cumsum(counts)-counts
+        neighbors=np.empty(counts.sum(),dtype=self._indices.dtype)
+        kept_counts,positions=self._entries(rows[~changed])
+        neighbors[_segments(offsets[~changed],kept_counts)]=self._indices[positions]
+        for i in np.flatnonzero(changed):
+            neighbors[offsets[i]:offsets[i]+counts[i]]=self._pending[rows[i]]
+        return counts,neighbors
+        
+    def degree(self):
+        """Returns the number of neighbor entries of every row"""
+        if self._degree is None:
+            self._degree=np.diff(self._indptr)
+        return self._degree
+        
+    def edges(self):
+        """Returns the network's undirected edges as an (E x 2) array with one row per
+        tied pair (i<=j), i.e. with repeated ties collapsed as in a NX Graph"""
+        if self._edges is None:
+            rows=self.row_ids()
+            low=np.minimum(rows,self.indices)
+            high=np.maximum(rows,self.indices)
+            width=max(self.size,high.max()+1 if len(high) else 0)
+            pair_keys=np.unique(low*width+high)
+            self._edges=np.column_stack((pair_keys//width,pair_keys%width))
+        return self._edges
+        
+    def row_ids(self):
+        """Returns the row of every entry in indices"""
+        return np.repeat(np.arange(self.size),self.degree())
+        
+    def sum_neighbors(self, values, rows=None):
+        """Sparse matrix-vector product: sums values over each row's neighbors, or only
+        over the neighbors of the given rows, in time proportional to their degrees"""
+        if rows is None:
+            return np.bincount(self.row_ids(),weights=np.asarray(values,dtype=float)[self.indices],minlength=self.size)
+        counts,neighbors=self.neighbors_of(rows)
+        return np.bincount(np.repeat(np.arange(len(counts)),counts),weights=np.asarray(values,dtype=float)[neighbors],
+            minlength=len(counts))
+        
+    def reduce_neighbors(self, ufunc, values, rows=None):
+        """Segmented reduction (e.g. ufunc=np.minimum) of values over the neighbors 
+        of the given rows (default all rows). Rows with no neighbors get NaN."""
+        if rows is None:
+            self._merge()
+            rows=np.arange(self.size)
+        # The selected rows' neighbors, in contiguous segments
+        counts,neighbors=self.neighbors_of(rows)
+        reduced=np.empty(len(counts))
+        reduced.fill(np.nan)
+        nonempty=counts>0
+        if nonempty.any():
+            offsets=(np.cumsum(counts)-counts)[nonempty]
+            reduced[nonempty]=ufunc.reduceat(np.asarray(values)[neighbors],offsets)
+        return reduced
+        
+        
+class Population(object):
+    """Array-backed store for the attributes of a population of agents
+    
+    Parameters
+    
+        size:           Number of agents in the population
+        agent_types:    Optional sequence of agent types (default types drawn at random)
+        rng:            Optional NumPy RandomState to draw attributes from (default the global state)
+    
+    Each attribute is held as one contiguous NumPy array, filled by a single vectorized 
+    draw, and agents are returned as lightweight Agent views onto a row of the store.
+    Unset contributions and m_net values are stored as NaN.
+    """
+    # Names of the per-agent attribute arrays
+    ARRAYS=("wealth","disposition","type","contrib","mnet","draws")
+    
+    def __init__(self, size, agent_types=None, rng=None):
+        if type(size) is not int or size<0:
+            raise ValueError("Population size must be a non-negative integer")
+        if rng is None:
+            rng=np.random
+        self.size=size
+        # Exogenous primitives: prior disposition to contributing, and level of wealth
+        self.disposition=rng.randint(low=0,high=2,size=size).astype(np.int8)
+        self.wealth=rng.pareto(3.,size=size)
+        # Set agent type, from one of five possible type:
+        #   0 - Altruistic: Always sets c=.5(wealth)
+        #   1 - Community:  Sets c=m' such that m'+m_net=w, given m_net
+        #   2 - Min-match:  Sets c=min(m') for all of agent's neighbors
+        #   3 - Max-match:  Sets c=max(m') for all of agent's neighbors
+        #   4 - Miserly:    Sets c=\epsilon
+        if agent_types is None:
+            self.type=rng.randint(low=0,high=5,size=size).astype(np.int8)
+        else:
+            self.type=np.asarray(agent_types,dtype=np.int8)
+            if len(self.type)!=size or not np.in1d(self.type,CONTRIB_RULES.keys()).all():
+                raise ValueError("Agent types must be size registered int types, by default between 0 and 4")
+        # Endogenous placeholders for level of contribution and m_net
+        self.contrib=np.empty(size)
+        self.contrib.fill(np.nan)
+        self.mnet=np.empty(size)
+        self.mnet.fill(np.nan)
+        # Uniform draws used by the stochastic contribution rules, drawn in one batch
+        self.draws=rng.random_sample(size)
+        # Agents' ego-networks
+        self.adjacency=Adjacency(size)
+        
+    @classmethod
+    def from_arrays(cls, **arrays):
+        """Returns a Population using existing (e.g. memory-mapped) attribute arrays,
+        given by keyword for each name in Population.ARRAYS"""
+        population=cls.__new__(cls)
+        for name in cls.ARRAYS:
+            setattr(population,name,arrays[name])
+        population.size=len(population.wealth)
+        population.adjacency=Adjacency(population.size)
+        return population
+        
+    def __len__(self):
+        return self.size
+        
+    def __getitem__(self, agent_id):
+        """Returns an Agent view onto the given row"""
+        agent_id=int(agent_id)
+        if agent_id<0:
+            agent_id+=self.size
+        if agent_id<0 or agent_id>=self.size:
+            raise IndexError("Population index out of range")
+        return Agent(agent_id=agent_id,population=self)
+        
+    def __iter__(self):
+        for a in xrange(self.size):
+            yield Agent(agent_id=a,population=self)
+            
+            
+### CONTRIBUTION RULES ###
+def altruistic_contrib(env,agents,threshold):
+    """Altruistic type: always contributes half of the agent's wealth"""
+    return 0.5*env.agents.disposition[agents]
+    
+def community_contrib(env,agents,threshold):
+    """Community type: contributes the wealth needed for m_net to meet the threshold,
+    committing all of its wealth if the threshold is out of reach"""
+    unmet=threshold-env.agents.mnet[agents] # Level of weath needed to meet threshold
+    return np.clip(unmet/env.agents.wealth[agents],0.0,1.0)*env.agents.disposition[agents]
+    
+def _match_contrib(env,agents,ufunc):
+    """Matches the min or max (per ufunc) of neighbors' wealth relative to m_net, capped
+    at 1. Agents with no m_net contribute a random share instead."""
+    mnet=env.agents.mnet[agents]
+    contribs=env.agents.draws[agents].copy()
+    matched=mnet>0
+    if matched.any():
+        neighbor_wealth=env.adjacency.reduce_neighbors(ufunc,env.agents.wealth,agents[matched])
+        contribs[matched]=np.minimum(neighbor_wealth/mnet[matched],1.0)
+    return contribs*env.agents.disposition[agents]
+    
+def min_match_contrib(env,agents,threshold):
+    """Min-match type: matches the poorest neighbor"""
+    return _match_contrib(env,agents,np.minimum)
+    
+def max_match_contrib(env,agents,threshold):
+    """Max-match type: matches the richest neighbor"""
+    return _match_contrib(env,agents,np.maximum)
+    
+def miserly_contrib(env,agents,threshold):
+    """Miserly type: contributes some \epsilon\in[0,.05)"""
+    return 0.05*env.agents.draws[agents]*env.agents.disposition[agents]
+    
+# Contribution rule for each agent type. A rule is called as rule(env,agents,threshold),
+# with agents an array of the ids of all agents of that type, and returns their contribution
+# levels as an array. The threshold is either a scalar or an array aligned with agents. Rules of types in THRESHOLD_TYPES are re-run whenever the threshold 
+# changes; all other rules are called once per built network, with threshold=None.
+CONTRIB_RULES={0:altruistic_contrib,1:community_contrib,2:min_match_contrib,3:max_match_contrib,4:miserly_contrib}
+THRESHOLD_TYPES=set([1])
+
+def register_agent_type(agent_type,rule,uses_threshold=False):
+    """Registers the contribution rule for a new (or replaced) agent type"""
+    if type(agent_type) is not int or agent_type<0 or agent_type>np.iinfo(np.int8).max:
+        raise ValueError("Agent type must be a non-negative int below 128")
+    CONTRIB_RULES[agent_type]=rule
+    if uses_threshold:
+        THRESHOLD_TYPES.add(agent_type)
+    else:
+        THRESHOLD_TYPES.discard(agent_type)
+        
+def set_contribs(env,agent_types,threshold,rows=None):
+    """Sets all agents of the given types contribution levels based on their network 
+    position. Each type's contribution rule is evaluated over all agents of that type at
+    once. The threshold is a scalar, or an array with one threshold per agent. If rows is
+    given, only those agents are set. Agents removed from an Environment are skipped."""
+    removed=getattr(env,"removed",None)
+    for agent_type in agent_types:
+        if rows is None:
+            agents=np.flatnonzero(env.agents.type==agent_type)
+        else:
+            agents=rows[env.agents.type[rows]==agent_type]
+        if removed is not None:
+            agents=agents[~removed[agents]]
+        if len(agents)>0:
+            agent_threshold=threshold if threshold is None or np.isscalar(threshold) else threshold[agents]
+            contribs=CONTRIB_RULES[agent_type](env,agents,agent_threshold)
+            if (contribs<0).any() or (contribs>1).any():
+                raise ValueError("Contribution level must be \in[0,1]")
+            env.agents.contrib[agents]=contribs
+    
+    
 class Environment(object):
     """The Environment in which the game is played
     
@@ -140,123 +783,244 @@ class Environment(object):
                         network a preferential attachment model based on wealth)
         m:              Optional fraction of total state wealth required to provide public good, i.e. the threhold.
                         As such, the value of m must \in[0,1], by default m=.25*state_wealth (1/4 of a state's total wealth)
+        seed:           Optional seed (int or sequence of ints) for the environment's own NumPy RandomState.
+                        By default all random draws come from the global NumPy random state.
+        hook:           Optional callable, called as hook(env,phase,seconds,nbytes) as each phase ends,
+                        with nbytes as recorded in result_bytes
+        network_cache:  NetworkCache of degree sequence networks (default NETWORK_CACHE), or None
+                        to always build the network
                         
     NOTE: BY INITIALIZAING THIS OBJECT YOU ARE---IN EFFECT---RUNNING A SIMULATION
     
+    Building the population, network and m_net is separate from evaluating the game, so
+    the same built Environment can be re-run at another threshold with evaluate(m).
+    
+    The wall-clock time of each phase ("population", "network", "mnet", "contribs", and
+    the latest "evaluate" and "output") is kept in the timings dict. The result_bytes dict
+    keeps the bytes of the new arrays each phase leaves in the model: the Population's
+    arrays, the network's CSR arrays (shared with the NetworkCache on a hit) and m_net.
+    It is not a count of everything a phase allocates: contribs and evaluate write into
+    existing arrays and output returns Python objects, so they record 0 bytes, and 
+    temporaries (e.g. masks and stub arrays) are not counted. Those are reflected in the
+    peak_rss_growth dict, the bytes by which each phase raised the process's peak resident
+    set size (ru_maxrss). It is 0 for a phase that stays below an earlier peak, and None
+    where the resource module is not available.
     """
-    def __init__(self, population,degree_seq=None,m=None):
+    # Names of the per-agent columns of get_columns
+    COLUMNS=("wealth","disposition","type","num_neighbors","mnet","contrib")
+    
+    def __init__(self, population,degree_seq=None,m=None,seed=None,hook=None,network_cache=NETWORK_CACHE):
+        self.seed=seed
+        self.hook=hook
+        self.timings={}
+        self.peak_rss_growth={}
+        self.result_bytes={}
+        if seed is None:
+            self.rng=np.random
+        else:
+            self.rng=np.random.RandomState(seed)
         # Create a population of agents
-        self.agents=list()
+        start=_phase_start()
         if type(population)==int and population>0:
-            for a in range(population):
-                self.agents.append(Agent(agent_id=a))
+            self.agents=Population(population,rng=self.rng)
         else:
             raise ValueError("Model must have positive number of agents")
+        # Agents taken out of the game with remove_agent
+        self.removed=np.zeros(population,dtype=bool)
         # Get total wealth in state
-        self.state_wealth=sum(map(lambda a: a.get_wealth(),self.agents))
-        if m is None:
-            self.threshold=.25*self.state_wealth
-        else:
-            if m>=0 and m<=1:
-                self.threshold=m*self.state_wealth
-            else:
-                raise ValueError("Value for m must be between 0 and 1")
+        self.state_wealth=float(self.agents.wealth.sum())
+        _record_phase(self,"population",start,sum(getattr(self.agents,name).nbytes for name in Population.ARRAYS))
+        m=_check_m(m)
         # Create network
+        start=_phase_start()
         if degree_seq is None:
         # If no degree sequence is provided create wealth-based preferential attachment
-        # This is the default setting for the model
-            for i in xrange(population):
-                for j in xrange(population):
-                    if i!=j:
-                        prob_tie=uniform(low=0,high=1)
-                        # Tie probability function of agent's wealth relative to 
-                        # total wealth in state
-                        if prob_tie<=self.agents[j].get_wealth()/self.state_wealth:
-                        # Create symmetric ties between neighbors
-                            self.agents[i].make_tie(self.agents[j])
-                            self.agents[j].make_tie(self.agents[i])
+        # This is the default setting for the model. Tie probability is a function of
+        # agent's wealth relative to total wealth in state
+            sources,targets=wealth_attachment_ties(self.agents.wealth,self.state_wealth,self.rng)
+            # Create symmetric ties between neighbors
+            self.agents.adjacency=Adjacency(population,sources,targets)
         else:
-            if(nx.is_valid_degree_sequence(degree_seq) and len(degree_seq)==population):
-                # Use NX configuration model to create network from degree sequence. By default,
-                # the configuration model returns a MultiGraph type with edges assigned at random.
-                # For consistency, the network type returned is Graph, and the random seed is
-                # always set to the number of agents in the environment.
-                G=nx.generators.configuration_model(degree_seq,create_using=nx.Graph(),seed=population)
-                for e in G.edges():
-                    self.agents[e[0]].make_tie(self.agents[e[1]])
-                    self.agents[e[1]].make_tie(self.agents[e[0]])
-            else:
+            # Validated before the cache lookup, so that the sequences accepted do not
+            # depend on what is cached
+            if len(degree_seq)!=population or not is_graphical(degree_seq):
                 raise nx.NetworkXError('Invalid degree sequence')
+            # The same sequence and population always give the same network
+            key=None if network_cache is None else network_cache.key(degree_seq,population)
+            adjacency=None if key is None else network_cache.get(key)
+            if adjacency is None:
+                sources,targets=_pair_stubs(degree_seq)
+                adjacency=Adjacency(population,sources,targets)
+                if key is not None:
+                    network_cache.put(key,adjacency)
+            self.agents.adjacency=adjacency
+        self.adjacency=self.agents.adjacency
+        _record_phase(self,"network",start,self.adjacency.indptr.nbytes+self.adjacency.indices.nbytes)
         # Calculate all agent's m_net parameter
-        for a in self.agents:  
-            agent_neighbors=a.get_neighbors()
-            # Get wealth of all neighbors
-            y_net=sum(map(lambda n: self.agents[n].get_wealth(),agent_neighbors))
-            # Calculate m_net
-            m_net=0
-            for n in agent_neighbors:
-                n_wealth=self.agents[n].get_wealth()
-                n_disposition=self.agents[n].get_disposition()
-                m_net+=n_disposition*(n_wealth/y_net)
-            a.set_mnet(m_net)
-        # Set all agents contribution levels based on their network position
-        for a in self.agents:
-            # Get all relevant agent info
-            agent_type=a.get_type()
-            agent_mnet=a.get_mnet()
-            agent_wealth=a.get_wealth()
-            agent_neighbors=a.get_neighbors()
-            if agent_type == 0:
-            # Altruistic type
-                a.set_contrib(0.5*a.get_disposition())
-            else:
-                if agent_type==1:
-                # Community type
-                    unmet=self.threshold-agent_mnet # Level of weath needed to meet threshold
-                    if unmet>0:
-                        if unmet<agent_wealth:
-                            a.set_contrib((unmet/agent_wealth)*a.get_disposition())
-                        else:
-                        # Agent commits all wealth if threshold out of reach
-                            a.set_contrib(1.0*a.get_disposition())
-                    else:
-                        a.set_contrib(0.0)
-                else:
-                    if agent_type==2:
-                    # Min-match type
-                        if agent_mnet>0:
-                            min_neighbor=min(map(lambda n: self.agents[n].get_wealth(),agent_neighbors))
-                            min_prop=min_neighbor/agent_mnet
-                            if min_prop<1:
-                                a.set_contrib(min_prop*a.get_disposition())
-                            else:
-                                a.set_contrib(1.0*a.get_disposition())
-                        else:
-                            a.set_contrib(random()*a.get_disposition())
-                    else:
-                        if agent_type==3:
-                        # Max-match type
-                            if agent_mnet>0:
-                                max_neighbor=max(map(lambda n: self.agents[n].get_wealth(),agent_neighbors))
-                                max_prop=max_neighbor/agent_mnet
-                                if max_prop<1:
-                                    a.set_contrib(max_prop*a.get_disposition())
-                                else:
-                                    a.set_contrib(1.0*a.get_disposition())
-                            else:
-                                a.set_contrib(random()*a.get_disposition())
-                        else:
-                        # Miserly type
-                            a.set_contrib(uniform(0.0,0.05)*a.get_disposition())
+        start=_phase_start()
+        mnet=net_mnet(self.adjacency,self.agents.wealth,self.agents.disposition)
+        self.agents.mnet[:]=mnet
+        _record_phase(self,"mnet",start,mnet.nbytes)
+        # Set the contribution levels that do not depend on the threshold once, then
+        # play the game at threshold m
+        start=_phase_start()
+        set_contribs(self,[t for t in CONTRIB_RULES if t not in THRESHOLD_TYPES],None)
+        _record_phase(self,"contribs",start)
+        self.evaluate(m)
+        
+    def evaluate(self,m=None):
+        """Plays the game on the built population and network with threshold m (see above),
+        and returns whether the public good is provided. Only the contributions of 
+        threshold-dependent types (by default Community agents) are recomputed."""
+        start=_phase_start()
+        self.m=_check_m(m)
+        self.threshold=self.m*self.state_wealth
+        set_contribs(self,[t for t in CONTRIB_RULES if t in THRESHOLD_TYPES],self.threshold)
         # Finally, check to see if threshold has been met
-        self.total_contribs=sum(map(lambda a: a.get_contrib()*a.get_wealth(),self.agents))
+        # Summed in agent order (rather than pairwise) to match a sum over get_contribs(as_dict=True)
+        self.total_contribs=float(np.cumsum(self.agents.contrib*self.agents.wealth)[-1])
         if(self.total_contribs>=self.threshold):
             self.threshold_met=True
         else:
             self.threshold_met=False
+        _record_phase(self,"evaluate",start)
+        return self.threshold_met
+        
+    def provision_curve(self):
+        """Returns the ProvisionCurve of total contributions as a function of m"""
+        return ProvisionCurve(self)
+        
+    def dynamics(self,m=None,max_rounds=100,tol=1e-9):
+        """Returns the ContributionDynamics of the multi-round game, played from the 
+        current contributions at threshold m (default the current threshold)"""
+        return ContributionDynamics(self,m,max_rounds,tol)
+        
+    ### NETWORK MUTATION ###
+    def _update_agents(self,rows):
+        """Recomputes the m_net and contribution levels of the given (unique) agents after
+        their ties changed, in time proportional to their degrees, and updates the total"""
+        rows=np.asarray(rows,dtype=int)
+        rows=rows[~self.removed[rows]]
+        before=self.agents.contrib[rows]*self.agents.wealth[rows]
+        y_net=self.adjacency.sum_neighbors(self.agents.wealth,rows)
+        d_net=self.adjacency.sum_neighbors(self.agents.disposition*self.agents.wealth,rows)
+        mnet=np.zeros(len(rows))
+        np.divide(d_net,y_net,out=mnet,where=y_net>0)
+        self.agents.mnet[rows]=mnet
+        set_contribs(self,[t for t in CONTRIB_RULES if t not in THRESHOLD_TYPES],None,rows)
+        set_contribs(self,[t for t in CONTRIB_RULES if t in THRESHOLD_TYPES],self.threshold,rows)
+        self.total_contribs+=float((self.agents.contrib[rows]*self.agents.wealth[rows]-before).sum())
+        self.threshold_met=self.total_contribs>=self.threshold
+        
+    def add_tie(self,source,target):
+        """Adds a symmetric tie between two agents, updating only their m_net and
+        contribution levels"""
+        self.adjacency.add_ties([source,target],[target,source])
+        self._update_agents(np.unique([source,target]))
+        
+    def remove_tie(self,source,target):
+        """Removes every tie between two agents, updating only their m_net and 
+        contribution levels"""
+        self.adjacency.remove_ties([source,target],[target,source])
+        self._update_agents(np.unique([source,target]))
+        
+    def remove_agent(self,agent_id):
+        """Takes an agent out of the game: its ties are cut, its wealth leaves the state 
+        and it no longer contributes. Its neighbors' m_net and contribution levels are
+        updated locally, and, as the threshold moves with state wealth, those of 
+        threshold-dependent types are re-evaluated (see evaluate)."""
+        if self.removed[agent_id]:
+            return self.threshold_met
+        neighbors=np.unique(self.adjacency.neighbors(agent_id))
+        others=neighbors[neighbors!=agent_id]
+        self.adjacency.remove_ties(np.concatenate(([agent_id]*len(neighbors),others)),
+            np.concatenate((neighbors,[agent_id]*len(others))))
+        self.removed[agent_id]=True
+        self.agents.contrib[agent_id]=0.0
+        self.agents.mnet[agent_id]=0.0
+        self.state_wealth-=float(self.agents.wealth[agent_id])
+        self._update_agents(others)
+        return self.evaluate(self.m)
+        
+    def _extremes(self,ufunc):
+        """Returns, for every agent, the first neighbor with the extreme (per ufunc) wealth,
+        that wealth, and the extreme wealth of the other neighbors (NaN if none)"""
+        wealth=self.agents.wealth
+        rows=self.adjacency.row_ids()
+        values=wealth[self.adjacency.indices]
+        extreme=self.adjacency.reduce_neighbors(ufunc,wealth)
+        hits=np.flatnonzero(values==extreme[rows])[::-1]
+        first=np.zeros(self.num_agents(),dtype=int)
+        first[rows[hits]]=self.adjacency.indices[hits]
+        identity=np.inf if ufunc is np.minimum else -np.inf
+        masked=np.where(self.adjacency.indices==first[rows],identity,values)
+        runner_up=np.empty(self.num_agents())
+        runner_up.fill(np.nan)
+        nonempty=self.adjacency.degree()>0
+        if nonempty.any():
+            runner_up[nonempty]=ufunc.reduceat(masked,self.adjacency.indptr[:-1][nonempty])
+        runner_up[np.isinf(runner_up)]=np.nan
+        return first,extreme,runner_up
+        
+    def knockout(self):
+        """Returns two arrays: for every agent, the change in total contributions if it 
+        were removed (see remove_agent), and whether the public good would then be provided.
+        
+        All agents are knocked out at once, without re-running the game per agent: the 
+        threshold-dependent (Community) contributions at each agent's reduced threshold 
+        come from the provision curve, and the changes to each removed agent's neighbors
+        are computed per tie. Only the built-in contribution rules are supported.
+        """
+        kinds={altruistic_contrib:None,miserly_contrib:None,community_contrib:"community",
+            min_match_contrib:np.minimum,max_match_contrib:np.maximum}
+        present=np.unique(self.agents.type)
+        if any(CONTRIB_RULES[t] not in kinds for t in present) or any(CONTRIB_RULES[t] is not community_contrib for t in THRESHOLD_TYPES):
+            raise ValueError("Knock-out analysis requires the built-in contribution rules")
+        n=self.num_agents()
+        wealth=self.agents.wealth
+        disposition=self.agents.disposition
+        contrib=self.agents.contrib
+        mnet=self.agents.mnet
+        kind=dict((t,kinds[CONTRIB_RULES[t]]) for t in present)
+        community=np.in1d(self.agents.type,[t for t in present if kind[t]=="community"])
+        # Each agent's threshold once its wealth has left the state
+        threshold=self.m*(self.state_wealth-wealth)
+        totals=self.provision_curve().total_contribs(threshold/self.state_wealth)
+        # Take out the removed agent's own contribution at its threshold
+        totals-=np.where(community,np.clip(threshold-mnet,0,wealth)*disposition,contrib*wealth)
+        # Each (removed agent, neighbor) pair, with the number of entries between them
+        rows=self.adjacency.row_ids()
+        pairs=rows!=self.adjacency.indices
+        pair_keys,mult=np.unique(rows[pairs]*n+self.adjacency.indices[pairs],return_counts=True)
+        k=pair_keys//n
+        j=pair_keys%n
+        y_net=self.adjacency.sum_neighbors(wealth)
+        d_net=self.adjacency.sum_neighbors(disposition*wealth)
+        remaining=self.adjacency.degree()[j]-mult>0
+        new_mnet=np.zeros(len(j))
+        np.divide(d_net[j]-mult*disposition[k]*wealth[k],y_net[j]-mult*wealth[k],out=new_mnet,where=remaining)
+        change=np.zeros(len(j))
+        in_community=community[j]
+        change[in_community]=(np.clip(threshold[k]-new_mnet,0,wealth[j])-np.clip(threshold[k]-mnet[j],0,wealth[j]))[in_community]*disposition[j][in_community]
+        for t in present:
+            if kind[t] in (np.minimum,np.maximum):
+                first,extreme,runner_up=self._extremes(kind[t])
+                of_type=np.flatnonzero(self.agents.type[j]==t)
+                a,b=k[of_type],j[of_type]
+                match=np.where(first[b]==a,runner_up[b],extreme[b])
+                matched=new_mnet[of_type]>0
+                level=self.agents.draws[b].copy()
+                level[matched]=np.minimum(match[matched]/new_mnet[of_type][matched],1.0)
+                change[of_type]=(level*disposition[b]-contrib[b])*wealth[b]
+        totals+=np.bincount(k,weights=change,minlength=n)
+        changes=totals-self.total_contribs
+        provided=totals>=threshold
+        changes[self.removed]=0.0
+        provided[self.removed]=self.threshold_met
+        return changes,provided
 
     def get_population(self):
-        """Return list of Agent classes"""
+        """Return the Population of agents, a sequence of Agent views"""
         return self.agents
         
     def num_agents(self):
@@ -277,7 +1041,7 @@ class Environment(object):
             
     def get_agent_ids(self):
         """Returns a list of agent IDS"""
-        return map(lambda a: a.get_id(),self.get_population())
+        return range(self.num_agents())
         
     def get_total_contribs(self):
         """Returns total number of contributions from agents"""
@@ -297,24 +1061,37 @@ class Environment(object):
         If as_sum=False, then returns a dict of contributions keyed by 
         agent ids."""
         if as_dict:
-            contrib_dict=dict.fromkeys(self.get_agent_ids())
-            for k in contrib_dict.keys():
-                contrib_dict[k]=self.get_population()[k].get_contrib()*self.get_population()[k].get_wealth()
-            return contrib_dict
+            return dict(enumerate((self.agents.contrib*self.agents.wealth).tolist()))
         else:
             return self.total_contribs
         
+    def get_columns(self):
+        """Returns the agent table as a dict of arrays keyed by COLUMNS, which e.g.
+        pandas.DataFrame accepts as is. Each array is a read-only view of the model's own
+        storage, so no per-agent objects or copies are made; the views follow the model
+        until its network changes, and should be copied before being modified."""
+        columns={"num_neighbors":self.adjacency.degree()}
+        for name in self.COLUMNS:
+            if name!="num_neighbors":
+                columns[name]=getattr(self.agents,name)
+        for name in self.COLUMNS:
+            columns[name]=columns[name].view()
+            columns[name].flags.writeable=False
+        return columns
+        
     def get_network(self,robust=False):
         """Returns the whole social network of all agents in 
-        the simulation as a NX Graph object
+        the simulation as a NX Graph object. The Graph is cached until
+        the network's ties change, so it should be copied before modifying it.
         """
-        agent_ids=self.get_agent_ids()
-        social_net=nx.Graph()
-        social_net.add_nodes_from(agent_ids)
-        for a in agent_ids:
-            new_edges=self.get_agent(a).get_egonet(as_graph=False)
-            social_net.add_edges_from(new_edges)
-        social_net.name="Social Network"
+        cached=getattr(self,"_network",None)
+        if cached is None or cached[0] is not self.adjacency or cached[1]!=self.adjacency.version:
+            social_net=nx.Graph()
+            social_net.add_nodes_from(self.get_agent_ids())
+            social_net.add_edges_from(self.adjacency.edges().tolist())
+            social_net.name="Social Network"
+            self._network=(self.adjacency,self.adjacency.version,social_net)
+        social_net=self._network[2]
         if robust:
             nx.info(social_net)
         return social_net
@@ -327,18 +1104,77 @@ class Environment(object):
         except IOError:
             print("Error file path: "+str(path))
             
-    def get_data(self,csv_path=None):
-        """Returns a dict of all relevant data from model"""
+    def save(self,path):
+        """Saves the full Environment (agent attributes, adjacency, m_net, contributions,
+        threshold and seed) as a directory of .npy arrays plus a JSON file of model data"""
+        try:
+            os.mkdir(path)
+        except(OSError):
+            pass
+        for name in Population.ARRAYS:
+            np.save(path+"/"+name+".npy",getattr(self.agents,name))
+        np.save(path+"/indptr.npy",self.adjacency.indptr)
+        np.save(path+"/indices.npy",self.adjacency.indices)
+        np.save(path+"/removed.npy",self.removed)
+        model={"population": self.num_agents(), "state_wealth": self.state_wealth, "m": self.m, "threshold": self.threshold,
+            "total_contribs": self.total_contribs, "threshold_met": self.threshold_met,
+            "seed": None if self.seed is None else np.asarray(self.seed).tolist()}
+        json.dump(model,open(path+"/model.json","w"))
+        
+    @classmethod
+    def load(cls,path,mmap_mode="c"):
+        """Returns an Environment saved with save(). By default arrays are memory-mapped
+        copy-on-write, so processes share the pages on disk and evaluate() writes stay 
+        private; use mmap_mode="r" for strictly read-only use, or None to read into memory.
+        A seeded environment's random state restarts from its seed."""
+        model=json.load(open(path+"/model.json"))
+        env=cls.__new__(cls)
+        env.seed=model["seed"]
+        env.hook=None
+        env.timings={}
+        env.peak_rss_growth={}
+        env.result_bytes={}
+        if env.seed is None:
+            env.rng=np.random
+        else:
+            env.rng=np.random.RandomState(env.seed)
+        arrays=dict((name,np.load(path+"/"+name+".npy",mmap_mode=mmap_mode)) for name in Population.ARRAYS)
+        env.agents=Population.from_arrays(**arrays)
+        env.agents.adjacency=Adjacency.from_csr(np.load(path+"/indptr.npy",mmap_mode=mmap_mode),
+            np.load(path+"/indices.npy",mmap_mode=mmap_mode))
+        env.adjacency=env.agents.adjacency
+        if os.path.exists(path+"/removed.npy"):
+            env.removed=np.load(path+"/removed.npy")
+        else:
+            env.removed=np.zeros(len(env.agents),dtype=bool)
+        env.state_wealth=model["state_wealth"]
+        env.m=model["m"]
+        env.threshold=model["threshold"]
+        env.total_contribs=model["total_contribs"]
+        env.threshold_met=model["threshold_met"]
+        return env
+        
+    def write_edgelist(self,path,binary=False):
+        """Writes the network's undirected edges straight from the adjacency store, 
+        without building a Graph: as plain two-column text, or if binary=True as 
+        little-endian int32 (int64 for very large networks) pairs"""
+        edges=self.adjacency.edges()
+        if binary:
+            dtype="<i4" if self.num_agents()<2**31 else "<i8"
+            edges.astype(dtype).tofile(path)
+        else:
+            np.savetxt(path,edges,fmt="%d")
+            
+    def get_data(self,csv_path=None,store=None,family=None,run=None):
+        """Returns a dict of all relevant data from model. The data are also written to 
+        csv_path if given, and added to store (e.g. an SB_store.ResultStore) as the given
+        family and run if given."""
+        start=_phase_start()
         model_data={"population": self.num_agents(), "state_wealth": self.get_state_wealth(), "threshold": self.threshold, "contribs": self.get_contribs(), "threshold_met": int(self.good_provided())}
-        agent_data=dict.fromkeys(self.get_agent_ids())
-        for a in xrange(self.num_agents()):
-            current_agent=self.get_population()[a]
-            agent_data[a]={}
-            agent_data[a]["wealth"]=current_agent.get_wealth()
-            agent_data[a]["disposition"]=current_agent.get_disposition()
-            agent_data[a]["type"]=current_agent.get_type()
-            agent_data[a]["num_neighbors"]=len(current_agent.get_egonet())
-            agent_data[a]["contrib"]=current_agent.get_contrib()
+        # Built column by column from get_columns, without per-agent getters
+        columns=self.get_columns()
+        names=["wealth","disposition","type","num_neighbors","contrib"]
+        agent_data=dict(enumerate(dict(zip(names,row)) for row in zip(*[columns[name].tolist() for name in names])))
         model_data["agent_data"]=agent_data
         if csv_path is not None:
             fn=agent_data[0].keys()
@@ -350,9 +1186,240 @@ class Environment(object):
                 row["threshold"]=model_data["threshold"]
                 row["threshold_met"]=model_data["threshold_met"]
                 writer.writerow(row)
+        if store is not None:
+            store.add_run(self,family,run)
+        _record_phase(self,"output",start)
         return model_data
 
 
+class ProvisionCurve(object):
+    """Total contributions of an Environment as a function of the threshold m
+    
+    Parameters
+    
+        env:            A built Environment
+    
+    Only Community contributions depend on the threshold, and each is piecewise linear in
+    the threshold T=m*state_wealth: an agent with disposition 1 gives min(max(T-m_net,0),wealth),
+    so total_contribs(m) is piecewise linear with breakpoints at m_net and m_net+wealth of
+    each such agent. The breakpoints are sorted once, in O(n log n), after which the curve 
+    is evaluated in O(log n) per value of m, and the critical values of m where provision
+    flips are found exactly, without re-running the game.
+    """
+    def __init__(self, env):
+        agent_types=set(np.unique(env.agents.type))
+        if agent_types & (THRESHOLD_TYPES-set([1])):
+            raise ValueError("Provision curve requires Community to be the only threshold-dependent type")
+        self.state_wealth=env.state_wealth
+        community=(env.agents.type==1) & (env.agents.disposition>0) & ~env.removed
+        fixed=~np.in1d(env.agents.type,list(THRESHOLD_TYPES))
+        # Contributions that do not depend on the threshold
+        self.fixed_contribs=float((env.agents.contrib[fixed]*env.agents.wealth[fixed]).sum())
+        # Thresholds at which Community agents start and stop increasing their contribution
+        self.starts=np.sort(env.agents.mnet[community])
+        self.stops=np.sort(env.agents.mnet[community]+env.agents.wealth[community])
+        self._start_sums=np.concatenate(([0.0],np.cumsum(self.starts)))
+        self._stop_sums=np.concatenate(([0.0],np.cumsum(self.stops)))
+        
+    def _ramp_sum(self, points, point_sums, threshold):
+        """Returns sum(max(threshold-point,0)) over sorted points"""
+        below=np.searchsorted(points,threshold)
+        return below*threshold-point_sums[below]
+        
+    def total_contribs(self, m):
+        """Returns total contributions at threshold m, a scalar or an array of values"""
+        threshold=np.asarray(m,dtype=float)*self.state_wealth
+        return self.fixed_contribs+self._ramp_sum(self.starts,self._start_sums,threshold)-self._ramp_sum(self.stops,self._stop_sums,threshold)
+        
+    def provided(self, m):
+        """Returns whether the public good is provided at threshold m (scalar or array)"""
+        return self.total_contribs(m)>=np.asarray(m,dtype=float)*self.state_wealth
+        
+    def breakpoints(self):
+        """Returns the sorted values of m\\in[0,1] at which the curve changes slope"""
+        m=np.union1d(self.starts,self.stops)/self.state_wealth
+        return m[(m>=0) & (m<=1)]
+        
+    def critical_thresholds(self):
+        """Returns the sorted values of m\\in[0,1] at which provision flips"""
+        m=np.union1d([0.0,1.0],self.breakpoints())
+        # Surplus of contributions over the threshold is linear between breakpoints
+        surplus=self.total_contribs(m)-m*self.state_wealth
+        flips=np.flatnonzero((surplus[:-1]>=0)!=(surplus[1:]>=0))
+        return m[flips]+surplus[flips]*(m[flips+1]-m[flips])/(surplus[flips]-surplus[flips+1])
+        
+    def critical_m(self):
+        """Returns the critical m*, the smallest m at which the public good stops being 
+        provided, or None if it is provided for all m\\in[0,1]"""
+        flips=self.critical_thresholds()
+        if len(flips)==0:
+            return None
+        return float(flips[0])
+
+
+class ContributionDynamics(object):
+    """Multi-round contribution dynamics of an Environment
+    
+    Parameters
+    
+        env:            A built and evaluated Environment
+        m:              Optional threshold (default the Environment's current m)
+        max_rounds:     Maximum number of rounds played
+        tol:            Smallest change in an agent's contribution level that counts as a change
+    
+    Starting from the Environment's contributions, in each round every agent's m_net is 
+    the share of its neighbors' wealth they contributed in the previous round (rather than
+    their disposition-weighted share), and agents re-apply their type's contribution rule.
+    Rounds are synchronous and are played until no agent changes, or max_rounds.
+    
+    Only agents with a neighbor that changed in the previous round are re-evaluated: the
+    changes are pushed through the adjacency into each neighbor's sum of contributed 
+    wealth, so a round costs time in the number of changed ties rather than n. The 
+    Environment itself is left unchanged.
+    
+    After construction rounds is the number of rounds in which contributions changed,
+    converged whether a fixed point was reached, and totals the total contributions 
+    after each round (totals[0] those of the Environment).
+    """
+    def __init__(self, env, m=None, max_rounds=100, tol=1e-9):
+        self.threshold=env.threshold if m is None else _check_m(m)*env.state_wealth
+        self.adjacency=env.adjacency
+        self.removed=env.removed
+        # The rules read m_net and write contributions through self.agents
+        arrays=dict((name,getattr(env.agents,name)) for name in Population.ARRAYS)
+        arrays["contrib"]=env.agents.contrib.copy()
+        arrays["mnet"]=np.zeros(len(env.agents))
+        self.agents=Population.from_arrays(**arrays)
+        wealth=self.agents.wealth
+        contrib=self.agents.contrib
+        y_net=self.adjacency.sum_neighbors(wealth)
+        # Each agent's sum of the wealth its neighbors contributed in the last round
+        given=self.adjacency.sum_neighbors(contrib*wealth)
+        self.totals=[env.total_contribs]
+        fixed_types=[t for t in CONTRIB_RULES if t not in THRESHOLD_TYPES]
+        threshold_types=[t for t in CONTRIB_RULES if t in THRESHOLD_TYPES]
+        frontier=np.flatnonzero(y_net>0)
+        self.rounds=0
+        self.converged=False
+        while self.rounds<max_rounds:
+            previous=contrib[frontier]
+            self.agents.mnet[frontier]=given[frontier]/y_net[frontier]
+            set_contribs(self,fixed_types,None,frontier)
+            set_contribs(self,threshold_types,self.threshold,frontier)
+            moved=np.abs(contrib[frontier]-previous)>tol
+            # Changes within tol are not kept, so given stays exact for the kept levels
+            contrib[frontier[~moved]]=previous[~moved]
+            changed=frontier[moved]
+            if len(changed)==0:
+                self.converged=True
+                break
+            self.rounds+=1
+            delta=(contrib[changed]-previous[moved])*wealth[changed]
+            counts,neighbors=self.adjacency.neighbors_of(changed)
+            np.add.at(given,neighbors,np.repeat(delta,counts))
+            self.totals.append(self.totals[-1]+float(delta.sum()))
+            frontier=np.unique(neighbors)
+            frontier=frontier[y_net[frontier]>0]
+        # Summed in agent order, as in Environment.evaluate
+        self.total_contribs=float(np.cumsum(contrib*wealth)[-1])
+        self.threshold_met=self.total_contribs>=self.threshold
+        
+    def good_provided(self):
+        """Returns whether the public good is provided at the end of the dynamics"""
+        return self.threshold_met
+
+
+class BatchEnvironment(object):
+    """Many replicates of the game, played at once
+    
+    Parameters
+    
+        replicates:     Number of replicate environments, K
+        population:     Number of agents in each replicate, n
+        degree_seq:     Optional degree sequence shared by all replicates, or a (K x n) array with one
+                        degree sequence per replicate (default network a preferential attachment 
+                        model based on wealth)
+        m:              Optional fraction of each replicate's total wealth required to provide public 
+                        good (see Environment)
+        seed:           Optional seed for the batch's own NumPy RandomState (see Environment)
+    
+    Equivalent to K separate Environment instances, but agents are stored as one Population
+    of K*n agents, viewed as (K x n) arrays, and the replicates' networks as a single 
+    block-diagonal Adjacency. Wealth draws, network generation, m_net, contributions and 
+    threshold checks each happen in one vectorized pass across all replicates, except for
+    the shuffle of each replicate's stubs by the configuration model, which is seeded per
+    replicate as in Environment and so is done one replicate at a time.
+    """
+    def __init__(self, replicates,population,degree_seq=None,m=None,seed=None):
+        self.seed=seed
+        if seed is None:
+            self.rng=np.random
+        else:
+            self.rng=np.random.RandomState(seed)
+        if not(type(replicates)==int and replicates>0 and type(population)==int and population>0):
+            raise ValueError("Model must have positive number of replicates and agents")
+        self.replicates=replicates
+        self.population=population
+        self.agents=Population(replicates*population,rng=self.rng)
+        # Get total wealth in each replicate's state
+        self.state_wealth=self.as_matrix(self.agents.wealth).sum(axis=1)
+        m=_check_m(m)
+        # Create networks
+        if degree_seq is None:
+            sources,targets=wealth_attachment_ties(self.agents.wealth,self.state_wealth,self.rng,block_size=population)
+        else:
+            degree_seq=np.asarray(degree_seq,dtype=int)
+            if degree_seq.shape==(population,):
+                # The configuration model is seeded by population, so every replicate
+                # would build the same network: build it once and repeat it
+                degree_seq=degree_seq.reshape(1,population)
+            elif degree_seq.shape!=(replicates,population):
+                raise nx.NetworkXError('Invalid degree sequence')
+            if not graphical_rows(degree_seq).all():
+                raise nx.NetworkXError('Invalid degree sequence')
+            # The sequences' stubs in one array, each sequence's shuffled as by 
+            # configuration_model_ties, then paired and deduplicated all at once
+            size=degree_seq.size
+            stubs=np.repeat(np.arange(size),degree_seq.ravel())
+            ends=np.cumsum(degree_seq.sum(axis=1))
+            for start,end in zip(ends-degree_seq.sum(axis=1),ends):
+                np.random.RandomState(population).shuffle(stubs[start:end])
+            pairs=stubs.reshape(-1,2)
+            pairs=pairs[pairs[:,0]!=pairs[:,1]]
+            pair_keys=np.unique(pairs.min(axis=1)*size+pairs.max(axis=1))
+            sources,targets=pair_keys//size,pair_keys%size
+            if len(degree_seq)<replicates:
+                offsets=(np.arange(replicates)*population).reshape(-1,1)
+                sources=(sources+offsets).ravel()
+                targets=(targets+offsets).ravel()
+        self.agents.adjacency=Adjacency(replicates*population,sources,targets)
+        self.adjacency=self.agents.adjacency
+        self.agents.mnet[:]=net_mnet(self.adjacency,self.agents.wealth,self.agents.disposition)
+        set_contribs(self,[t for t in CONTRIB_RULES if t not in THRESHOLD_TYPES],None)
+        self.evaluate(m)
+        
+    def evaluate(self,m=None):
+        """Plays the game in every replicate with threshold m, and returns a boolean array 
+        of whether each replicate's public good is provided (see Environment.evaluate)"""
+        self.m=_check_m(m)
+        self.threshold=self.m*self.state_wealth
+        set_contribs(self,[t for t in CONTRIB_RULES if t in THRESHOLD_TYPES],np.repeat(self.threshold,self.population))
+        # Summed in agent order within each replicate, as in Environment
+        self.total_contribs=np.cumsum(self.as_matrix(self.agents.contrib*self.agents.wealth),axis=1)[:,-1]
+        self.threshold_met=self.total_contribs>=self.threshold
+        return self.threshold_met
+        
+    def as_matrix(self,values):
+        """Returns a per-agent array as a (K x n) view, one row per replicate"""
+        return np.asarray(values).reshape(self.replicates,self.population)
+        
+    def summaries(self):
+        """Returns a list with a dict of model data per replicate, as in Environment.get_data"""
+        return [{"population":self.population,"state_wealth":float(self.state_wealth[k]),
+            "threshold":float(self.threshold[k]),"contribs":float(self.total_contribs[k]),
+            "threshold_met":int(self.threshold_met[k])} for k in xrange(self.replicates)]
+
+
 class TestAgent(unittest.TestCase):
     """Test case for Agent class"""
     
@@ -464,6 +1531,227 @@ class TestEnvironment(unittest.TestCase):
         con_net_edges=config_net.edges()
         self.assertEquals(len(con_net_edges),len(config_edges))
         
+    def test_mnet(self):
+        """Tests that m_net is the disposition-weighted share of neighbors' wealth"""
+        for a in self.environment_config.get_population():
+            neighbors=a.get_neighbors()
+            y_net=sum(self.environment_config.get_agent(n).get_wealth() for n in neighbors)
+            m_net=0
+            for n in neighbors:
+                n_agent=self.environment_config.get_agent(n)
+                m_net+=n_agent.get_disposition()*(n_agent.get_wealth()/y_net)
+            self.assertAlmostEquals(m_net,a.get_mnet())
+        
+    def test_contribs(self):
+        """Tests the vectorized contribution rules against the per-agent rules"""
+        env=self.environment_default
+        threshold=env.get_threshold()
+        for a in env.get_population():
+            agent_type=a.get_type()
+            agent_mnet=a.get_mnet()
+            agent_wealth=a.get_wealth()
+            draw=env.agents.draws[a.get_id()]
+            if agent_type==0:
+                contrib=0.5
+            elif agent_type==1:
+                unmet=threshold-agent_mnet
+                contrib=0.0 if unmet<=0 else min(unmet/agent_wealth,1.0)
+            elif agent_type==2 or agent_type==3:
+                if agent_mnet>0:
+                    neighbor_wealth=map(lambda n: env.get_agent(n).get_wealth(),a.get_neighbors())
+                    match=min(neighbor_wealth) if agent_type==2 else max(neighbor_wealth)
+                    contrib=min(match/agent_mnet,1.0)
+                else:
+                    contrib=draw
+            else:
+                contrib=0.05*draw
+            self.assertAlmostEquals(contrib*a.get_disposition(),a.get_contrib())
+            
+    def test_register_agent_type(self):
+        """Tests that additional agent types can be registered"""
+        register_agent_type(5,lambda env,agents,threshold: np.ones(len(agents)),uses_threshold=True)
+        try:
+            self.assertEquals(Agent(agent_id=0,agent_type=5).get_type(),5)
+            self.assertEquals(list(Population(2,[5,0]).type),[5,0])
+            env=self.environment_default
+            env.agents.type[:3]=5
+            env.evaluate()
+            self.assertEquals(list(env.agents.contrib[:3]),[1.,1.,1.])
+        finally:
+            del CONTRIB_RULES[5]
+            THRESHOLD_TYPES.discard(5)
+        self.assertRaises(ValueError,Agent,0,5)
+        self.assertRaises(ValueError,register_agent_type,128,altruistic_contrib)
+        
+    def test_seed(self):
+        """Tests that seeded environments are reproducible"""
+        for degree_seq in (None,self.ds):
+            env_a=Environment(population=self.pop,degree_seq=degree_seq,seed=[7,1])
+            env_b=Environment(population=self.pop,degree_seq=degree_seq,seed=[7,1])
+            env_c=Environment(population=self.pop,degree_seq=degree_seq,seed=[7,2])
+            self.assertTrue((env_a.agents.contrib==env_b.agents.contrib).all())
+            self.assertTrue((env_a.adjacency.indices==env_b.adjacency.indices).all())
+            self.assertEquals(env_a.get_total_contribs(),env_b.get_total_contribs())
+            self.assertFalse((env_a.agents.wealth==env_c.agents.wealth).all())
+        
+    def test_evaluate(self):
+        """Tests that re-evaluating at a new threshold only changes threshold-dependent contributions"""
+        env=self.environment_config
+        total=env.get_total_contribs()
+        contribs=env.agents.contrib.copy()
+        community=env.agents.type==1
+        env.evaluate(m=.6)
+        self.assertAlmostEquals(env.get_threshold(),.6*env.get_state_wealth())
+        self.assertTrue((env.agents.contrib[~community]==contribs[~community]).all())
+        self.assertTrue((env.agents.contrib[community]>=contribs[community]).all())
+        self.assertEquals(env.good_provided(),env.get_total_contribs()>=env.get_threshold())
+        env.evaluate()
+        self.assertEquals(env.get_total_contribs(),total)
+        self.assertRaises(ValueError,env.evaluate,1.5)
+        
+    def test_provision_curve(self):
+        """Tests the provision curve against re-evaluating the game over a grid of m"""
+        for env in (self.environment_default,self.environment_config):
+            curve=env.provision_curve()
+            grid=np.linspace(0,1,41)
+            totals=curve.total_contribs(grid)
+            for m,total in zip(grid,totals):
+                env.evaluate(m)
+                self.assertAlmostEquals(total,env.get_total_contribs())
+            for m in curve.critical_thresholds():
+                for side in (m-1e-9,m+1e-9):
+                    if side>=0 and side<=1:
+                        self.assertEquals(env.evaluate(side),bool(curve.provided(side)))
+            m_star=curve.critical_m()
+            if m_star is not None and m_star+1e-9<=1:
+                self.assertTrue(env.evaluate(max(m_star-1e-9,0)))
+                self.assertFalse(env.evaluate(m_star+1e-9))
+            env.evaluate()
+        
+    def test_dynamics(self):
+        """Tests the worklist dynamics against recomputing every agent each round"""
+        for env in (self.environment_default,self.environment_config):
+            dynamics=env.dynamics(max_rounds=50,tol=0)
+            contribs=env.agents.contrib.copy()
+            totals=[env.get_total_contribs()]
+            y_net=env.adjacency.sum_neighbors(env.agents.wealth)
+            for r in xrange(dynamics.rounds):
+                given=env.adjacency.sum_neighbors(contribs*env.agents.wealth)
+                round_env=Environment.__new__(Environment)
+                round_env.adjacency=env.adjacency
+                round_env.agents=Population.from_arrays(**dict((name,getattr(env.agents,name)) for name in Population.ARRAYS))
+                round_env.agents.contrib=contribs.copy()
+                round_env.agents.mnet=np.where(y_net>0,given/np.maximum(y_net,1e-300),env.agents.mnet)
+                set_contribs(round_env,CONTRIB_RULES.keys(),env.get_threshold())
+                contribs=round_env.agents.contrib
+                totals.append((contribs*env.agents.wealth).sum())
+            self.assertTrue(np.allclose(contribs,dynamics.agents.contrib))
+            self.assertTrue(np.allclose(totals,dynamics.totals))
+            self.assertEquals(len(dynamics.totals),dynamics.rounds+1)
+            self.assertEquals(dynamics.good_provided(),dynamics.total_contribs>=env.get_threshold())
+            self.assertTrue(np.isnan(env.agents.contrib).sum()==0 and env.agents.contrib is not dynamics.agents.contrib)
+        self.assertTrue(self.environment_default.dynamics(max_rounds=0).rounds==0)
+
+    def test_mutation(self):
+        """Tests local updates after adding and removing ties and agents against 
+        recomputing every agent"""
+        for env in (self.environment_default,self.environment_config):
+            i,j=np.argsort(env.adjacency.degree())[-2:]
+            env.add_tie(i,0)
+            env.remove_tie(i,j)
+            env.remove_agent(j)
+            self.assertFalse(j in env.adjacency.neighbors(i) or len(env.adjacency.neighbors(j)))
+            self.assertEquals(env.agents.contrib[j],0)
+            mnet=net_mnet(env.adjacency,env.agents.wealth,env.agents.disposition)
+            mnet[j]=0
+            self.assertTrue(np.allclose(env.agents.mnet,mnet))
+            contribs=env.agents.contrib.copy()
+            set_contribs(env,CONTRIB_RULES.keys(),env.get_threshold())
+            self.assertTrue(np.allclose(contribs,env.agents.contrib))
+            self.assertAlmostEquals(env.get_total_contribs(),(env.agents.contrib*env.agents.wealth).sum())
+            self.assertAlmostEquals(env.get_threshold(),env.m*(env.agents.wealth.sum()-env.agents.wealth[j]))
+        
+    def test_knockout(self):
+        """Tests the batched knock-out analysis against removing each agent in turn, at a
+        threshold where removals flip provision"""
+        for degree_seq in (None,self.ds):
+            env=Environment(self.pop,degree_seq=degree_seq,seed=3)
+            m=env.provision_curve().critical_thresholds()
+            env.evaluate(m[len(m)//2] if len(m) else .5)
+            changes,provided=env.knockout()
+            for k in xrange(self.pop):
+                knocked=Environment(self.pop,degree_seq=degree_seq,seed=3)
+                knocked.evaluate(env.m)
+                total=knocked.get_total_contribs()
+                self.assertEquals(knocked.remove_agent(k),provided[k])
+                self.assertAlmostEquals(knocked.get_total_contribs()-total,changes[k])
+            env.remove_agent(0)
+            changes,provided=env.knockout()
+            self.assertEquals((changes[0],provided[0]),(0,env.threshold_met))
+        
+    def test_timings(self):
+        """Tests that every phase is timed and passed to the hook"""
+        events=[]
+        env=Environment(population=self.pop,hook=lambda env,phase,seconds,nbytes: events.append((phase,seconds,nbytes)))
+        self.assertEquals([e[0] for e in events],["population","network","mnet","contribs","evaluate"])
+        self.assertEquals(dict((e[0],e[1]) for e in events),env.timings)
+        self.assertTrue(all(seconds>=0 for seconds in env.timings.values()))
+        self.assertEquals(env.result_bytes["network"],env.adjacency.indptr.nbytes+env.adjacency.indices.nbytes)
+        self.assertEquals(env.result_bytes["contribs"],0)
+        self.assertEquals(sorted(env.peak_rss_growth),sorted(env.timings))
+        self.assertTrue(all(nbytes>=0 for nbytes in env.peak_rss_growth.values()))
+        env.evaluate(m=.5)
+        env.get_data()
+        self.assertEquals([e[0] for e in events[-2:]],["evaluate","output"])
+        self.assertEquals(self.environment_default.hook,None)
+
+    def test_network_cache(self):
+        """Tests that network views are cached until ties change, and the edge export"""
+        env=self.environment_default
+        net=env.get_network()
+        self.assertTrue(env.get_network() is net)
+        self.assertTrue(env.get_agent(0).get_egonet(as_graph=True) is env.get_agent(0).get_egonet(as_graph=True))
+        edges=env.adjacency.edges()
+        self.assertEquals(sorted(map(tuple,edges.tolist())),sorted(tuple(sorted(e)) for e in net.edges()))
+        path=tempfile.mktemp()
+        try:
+            env.write_edgelist(path)
+            self.assertTrue((np.loadtxt(path,dtype=int).reshape(-1,2)==edges).all())
+            env.write_edgelist(path,binary=True)
+            self.assertTrue((np.fromfile(path,dtype="<i4").reshape(-1,2)==edges).all())
+        finally:
+            os.remove(path)
+        env.get_agent(2).make_tie(env.get_agent(1))
+        self.assertFalse(env.get_network() is net)
+        self.assertTrue(env.get_network().has_edge(1,2))
+        
+    def test_save_load(self):
+        """Tests that a saved Environment loads back, memory-mapped, unchanged"""
+        path=tempfile.mkdtemp()
+        try:
+            env=Environment(population=self.pop,seed=[5])
+            env.save(path)
+            loaded=Environment.load(path)
+            self.assertTrue(isinstance(loaded.agents.wealth,np.memmap))
+            for name in Population.ARRAYS:
+                self.assertTrue((getattr(loaded.agents,name)==getattr(env.agents,name)).all())
+            self.assertTrue((loaded.adjacency.indices==env.adjacency.indices).all())
+            self.assertEquals(loaded.get_total_contribs(),env.get_total_contribs())
+            self.assertEquals(loaded.good_provided(),env.good_provided())
+            self.assertEquals(loaded.seed,[5])
+            self.assertEquals(loaded.get_agent(3).get_neighbors().tolist(),env.get_agent(3).get_neighbors().tolist())
+            # Re-evaluating a copy-on-write snapshot leaves the saved arrays unchanged
+            loaded.evaluate(m=.1)
+            env.evaluate(m=.1)
+            self.assertEquals(loaded.get_total_contribs(),env.get_total_contribs())
+            loaded.agents.contrib[:]=0
+            self.assertRaises(ValueError,Environment.load(path,mmap_mode="r").evaluate,.1)
+            reloaded=Environment.load(path,mmap_mode=None)
+            self.assertEquals(reloaded.m,.25)
+            self.assertTrue((reloaded.agents.contrib>0).any())
+        finally:
+            shutil.rmtree(path)
+            
     def test_treshold(self):
         """Tests to verify that treshold parameter set correctly"""
         #Default model first
@@ -493,6 +1781,317 @@ class TestEnvironment(unittest.TestCase):
             self.assertTrue(test_agent[i]["contrib"]>=0)
         # Test CSV output
         
+    def test_columns(self):
+        """Tests that the columns are read-only views matching the agent getters"""
+        env=self.environment_config
+        columns=env.get_columns()
+        self.assertEquals(sorted(columns.keys()),sorted(Environment.COLUMNS))
+        for a in env.get_agent_ids():
+            agent=env.get_agent(a)
+            self.assertEquals(columns["wealth"][a],agent.get_wealth())
+            self.assertEquals(columns["type"][a],agent.get_type())
+            self.assertEquals(columns["num_neighbors"][a],len(agent.get_neighbors()))
+            self.assertEquals(columns["contrib"][a],agent.get_contrib())
+        self.assertTrue(np.may_share_memory(columns["contrib"],env.agents.contrib))
+        self.assertTrue(np.may_share_memory(columns["num_neighbors"],env.adjacency.degree()))
+        self.assertRaises(ValueError,columns["wealth"].__setitem__,0,1.0)
+        contribs=env.get_contribs(as_dict=True)
+        self.assertEquals(contribs[1],env.get_agent(1).get_contrib()*env.get_agent(1).get_wealth())
+        self.assertEquals(env.get_data()["agent_data"][2]["disposition"],env.get_agent(2).get_disposition())
+        
+
+class TestBatchEnvironment(unittest.TestCase):
+    """Test case for the BatchEnvironment class"""
+    
+    replicates=20
+    pop=50
+    
+    def setUp(self):
+        """Initialize a batch of wealth-attachment replicates"""
+        self.batch=BatchEnvironment(self.replicates,self.pop,seed=3)
+        
+    def test_block_diagonal(self):
+        """Test that replicates' networks are separate"""
+        rows=self.batch.adjacency.row_ids()
+        self.assertTrue((rows/self.pop==self.batch.adjacency.indices/self.pop).all())
+        self.assertFalse((rows==self.batch.adjacency.indices).any())
+        # Each replicate's wealth-attachment network has n-1 ties in expectation
+        num_ties=len(rows)/2.
+        expected=self.replicates*(self.pop-1)
+        self.assertTrue(abs(num_ties-expected)<5*np.sqrt(expected))
+        
+    def test_summaries(self):
+        """Test that per-replicate summaries match the replicates' agents"""
+        wealth=self.batch.as_matrix(self.batch.agents.wealth)
+        contribs=self.batch.as_matrix(self.batch.agents.contrib)
+        for k,summary in enumerate(self.batch.summaries()):
+            self.assertAlmostEquals(summary["state_wealth"],wealth[k].sum())
+            self.assertAlmostEquals(summary["threshold"],.25*wealth[k].sum())
+            self.assertAlmostEquals(summary["contribs"],(contribs[k]*wealth[k]).sum())
+            self.assertEquals(summary["threshold_met"],int(summary["contribs"]>=summary["threshold"]))
+        met=self.batch.evaluate(m=.9)
+        self.assertTrue((self.batch.threshold==.9*self.batch.state_wealth).all())
+        self.assertTrue((met==(self.batch.total_contribs>=self.batch.threshold)).all())
+        
+    def test_degree_seq(self):
+        """Test that replicates built from a degree sequence match an Environment's network"""
+        ds=TestEnvironment.ds
+        batch=BatchEnvironment(3,len(ds),degree_seq=ds)
+        env=Environment(population=len(ds),degree_seq=ds)
+        for k in xrange(3):
+            for i in xrange(len(ds)):
+                self.assertEquals(sorted(batch.adjacency.neighbors(k*len(ds)+i)-k*len(ds)),sorted(env.adjacency.neighbors(i)))
+        self.assertRaises(nx.NetworkXError,BatchEnvironment,2,len(ds),np.ones((3,len(ds))))
+        # One sequence per replicate gives each replicate the network built from its own
+        rows=np.vstack((ds,np.roll(ds,1)))
+        batch=BatchEnvironment(2,len(ds),degree_seq=rows)
+        for k in xrange(2):
+            sources,targets=configuration_model_ties(rows[k].tolist())
+            block=Adjacency(len(ds),sources,targets)
+            for i in xrange(len(ds)):
+                self.assertEquals(list(batch.adjacency.neighbors(k*len(ds)+i)-k*len(ds)),list(block.neighbors(i)))
+        rows[1,0]=len(ds)
+        self.assertRaises(nx.NetworkXError,BatchEnvironment,2,len(ds),rows)
+        
+
+class TestAdjacency(unittest.TestCase):
+    """Test case for the CSR adjacency store"""
+    
+    def setUp(self):
+        """Initialize a small network with a repeated tie and an isolate"""
+        self.adjacency=Adjacency(5,[0,0,1,0],[1,2,2,1])
+        
+    def test_neighbors(self):
+        """Test that ties are symmetric and neighbor slices are views"""
+        self.assertEquals(sorted(self.adjacency.neighbors(0)),[1,1,2])
+        self.assertEquals(sorted(self.adjacency.neighbors(2)),[0,1])
+        self.assertEquals(list(self.adjacency.neighbors(4)),[])
+        self.assertEquals(list(self.adjacency.degree()),[3,3,2,0,0])
+        self.assertTrue(np.may_share_memory(self.adjacency.neighbors(1),self.adjacency.indices))
+        self.adjacency.add_ties([3],[4])
+        self.assertEquals(list(self.adjacency.neighbors(3)),[4])
+        self.assertEquals(list(self.adjacency.neighbors(4)),[])
+        
+    def test_reduce_neighbors(self):
+        """Test segmented min/max against a loop over neighbors"""
+        values=np.array([3.,1.,4.,1.,5.])
+        mins=self.adjacency.reduce_neighbors(np.minimum,values)
+        maxs=self.adjacency.reduce_neighbors(np.maximum,values,[4,2,0])
+        self.assertEquals(list(mins[:3]),[1.,3.,1.])
+        self.assertTrue(np.isnan(mins[3:]).all())
+        self.assertTrue(np.isnan(maxs[0]))
+        self.assertEquals(list(maxs[1:]),[3.,4.])
+        
+    def test_sum_neighbors(self):
+        """Test the sparse matrix-vector product against a loop over neighbors"""
+        values=np.arange(1.,6.)
+        sums=self.adjacency.sum_neighbors(values)
+        for i in xrange(5):
+            self.assertAlmostEquals(sums[i],sum(values[n] for n in self.adjacency.neighbors(i)))
+                
+    def test_remove_ties(self):
+        """Test that removing directed ties drops every matching entry"""
+        self.adjacency.remove_ties([0,1,3,0],[1,0,4,1])
+        self.assertEquals(list(self.adjacency.neighbors(0)),[2])
+        self.assertEquals(list(self.adjacency.neighbors(1)),[2])
+        self.assertEquals(list(self.adjacency.degree()),[1,1,2,0,0])
+        self.adjacency.remove_ties([2],[0])
+        self.assertEquals(list(self.adjacency.neighbors(2)),[1])
+        self.assertEquals(list(self.adjacency.neighbors(0)),[2])
+        
+    def test_pending(self):
+        """Test that changed rows are read without merging, and merged as rebuilt"""
+        indices=self.adjacency.indices
+        self.adjacency.add_ties([3,4,3],[4,3,0])
+        self.adjacency.remove_ties([1,0],[0,1])
+        self.assertEquals(sorted(self.adjacency._pending),[0,1,3,4])
+        self.assertEquals(list(self.adjacency.degree()),[1,1,2,2,1])
+        counts,neighbors=self.adjacency.neighbors_of([2,3,1])
+        self.assertEquals(list(counts),[2,2,1])
+        self.assertEquals(list(neighbors),[0,1,4,0,2])
+        values=np.array([3.,1.,4.,1.,5.])
+        self.assertEquals(list(self.adjacency.sum_neighbors(values,[3,0])),[8.,4.])
+        self.assertEquals(list(self.adjacency.reduce_neighbors(np.maximum,values,[4,2])),[1.,3.])
+        self.assertTrue(self.adjacency.indices is not indices and not self.adjacency._pending)
+        rebuilt=Adjacency(5,[0,1,3],[2,2,4])
+        rebuilt.add_ties([3],[0])
+        for i in xrange(5):
+            self.assertEquals(list(self.adjacency.neighbors(i)),list(rebuilt.neighbors(i)))
+        self.assertEquals(list(self.adjacency.indptr),list(rebuilt.indptr))
+
+
+class TestPopulation(unittest.TestCase):
+    """Test case for the array-backed Population store"""
+    
+    size=50
+    
+    def setUp(self):
+        """Initialize a Population store"""
+        self.population=Population(self.size)
+        
+    def test_views(self):
+        """Test that Agent views read and write through to the store"""
+        self.assertEquals(len(self.population),self.size)
+        agent=self.population[3]
+        self.assertEquals(agent.get_id(),3)
+        self.assertEquals(agent.get_wealth(),self.population.wealth[3])
+        self.assertTrue(agent.get_contrib() is None and agent.get_mnet() is None)
+        agent.set_contrib(.5)
+        self.assertEquals(self.population.contrib[3],.5)
+        self.assertEquals(self.population[3].get_contrib(),.5)
+        self.assertRaises(IndexError,self.population.__getitem__,self.size)
+        self.assertEquals([a.get_id() for a in self.population],range(self.size))
+        
+    def test_attributes(self):
+        """Test that vectorized draws are in range"""
+        self.assertTrue((self.population.wealth>0).all())
+        self.assertTrue(np.in1d(self.population.disposition,[0,1]).all())
+        self.assertTrue(((self.population.type>=0) & (self.population.type<=4)).all())
+        self.assertRaises(ValueError,Population,3,[0,1,5])
+        
+    def test_ties(self):
+        """Test that ties made between views are stored by the population"""
+        self.population[0].make_tie(self.population[1])
+        self.assertEquals(list(self.population[0].get_neighbors()),[1])
+        self.assertEquals(list(self.population[1].get_neighbors()),[])
+        
+
+class TestConfigurationModel(unittest.TestCase):
+    """Test case for the native configuration model"""
+    
+    def test_is_graphical(self):
+        """Test the Erdos-Gallai check against NX's Havel-Hakimi check"""
+        rng=np.random.RandomState(4)
+        for r in xrange(300):
+            n=rng.randint(1,12)
+            ds=rng.randint(0,n+1,size=n).tolist()
+            self.assertEquals(is_graphical(ds),nx.is_valid_degree_sequence(ds))
+        self.assertTrue(is_graphical([]))
+        self.assertFalse(is_graphical([1.,1.]))
+        self.assertFalse(is_graphical([2,-1,1]))
+        rows=rng.randint(0,8,size=(200,8))
+        self.assertEquals(graphical_rows(rows).tolist(),[nx.is_valid_degree_sequence(r) for r in rows.tolist()])
+        
+    def test_ties(self):
+        """Test that ties are simple and match the degree sequence up to dropped ties"""
+        ds=TestEnvironment.ds
+        sources,targets=configuration_model_ties(ds)
+        self.assertTrue((sources<targets).all())
+        self.assertEquals(len(set(zip(sources,targets))),len(sources))
+        degree=np.bincount(np.concatenate((sources,targets)),minlength=len(ds))
+        self.assertTrue((degree<=np.asarray(ds)).all())
+        # With one stub per agent no tie can be dropped
+        self.assertEquals(len(configuration_model_ties([1]*10)[0]),5)
+        self.assertTrue((configuration_model_ties(ds)[0]==sources).all())
+        self.assertRaises(nx.NetworkXError,configuration_model_ties,[3,1])
+        
+
+class TestNetworkCache(unittest.TestCase):
+    """Test case for the cache of degree sequence networks"""
+    
+    def setUp(self):
+        self.cache_dir=tempfile.mkdtemp()
+        self.ds=[[1+(i+k)%4 for i in xrange(40)] for k in xrange(4)]
+        
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        
+    def test_hits(self):
+        """Test that cached networks are the networks that would be built"""
+        cache=NetworkCache()
+        built=Environment(40,degree_seq=self.ds[0],seed=1,network_cache=None)
+        first=Environment(40,degree_seq=self.ds[0],seed=1,network_cache=cache)
+        second=Environment(40,degree_seq=np.array(self.ds[0]),seed=2,network_cache=cache)
+        self.assertEquals((cache.hits,cache.misses),(1,1))
+        for env in (first,second):
+            self.assertTrue((env.adjacency.indptr==built.adjacency.indptr).all())
+            self.assertTrue((env.adjacency.indices==built.adjacency.indices).all())
+        self.assertTrue(np.allclose(first.agents.mnet,built.agents.mnet))
+        # Changing one Environment's ties leaves the cached network intact
+        second.add_tie(0,1)
+        self.assertTrue(1 in second.adjacency.neighbors(0))
+        third=Environment(40,degree_seq=self.ds[0],network_cache=cache)
+        self.assertTrue((third.adjacency.indices==built.adjacency.indices).all())
+        self.assertRaises(ValueError,first.adjacency.indices.__setitem__,0,0)
+        # A cached sequence does not make an invalid one with the same integer values valid
+        Environment(3,degree_seq=[2,2,2],network_cache=cache)
+        self.assertRaises(nx.NetworkXError,Environment,3,[2.,2.,2.],None,None,None,cache)
+        
+    def test_eviction(self):
+        """Test that the least recently used networks are evicted past either limit"""
+        cache=NetworkCache(max_entries=2)
+        for k in (0,1,0,2):
+            Environment(40,degree_seq=self.ds[k],network_cache=cache)
+        self.assertEquals(cache.stats()["entries"],2)
+        self.assertEquals((cache.hits,cache.misses,cache.evictions),(1,3,1))
+        self.assertTrue(cache.key(self.ds[0],40) in cache.entries and cache.key(self.ds[1],40) not in cache.entries)
+        nbytes=cache.nbytes
+        cache=NetworkCache(max_bytes=nbytes)
+        for k in xrange(4):
+            Environment(40,degree_seq=self.ds[k],network_cache=cache)
+        self.assertTrue(cache.nbytes<=nbytes and cache.evictions>0)
+        
+    def test_disk(self):
+        """Test that networks cached on disk are shared between caches"""
+        Environment(40,degree_seq=self.ds[0],network_cache=NetworkCache(path=self.cache_dir))
+        cache=NetworkCache(path=self.cache_dir,max_disk_bytes=1)
+        env=Environment(40,degree_seq=self.ds[0],network_cache=cache)
+        self.assertEquals((cache.hits,cache.misses),(1,0))
+        self.assertEquals(list(env.adjacency.degree()),list(Environment(40,degree_seq=self.ds[0],network_cache=None).adjacency.degree()))
+        # Past the disk limit, the oldest files are removed
+        Environment(40,degree_seq=self.ds[1],network_cache=cache)
+        self.assertTrue(len(os.listdir(self.cache_dir))<=1)
+        
+        
+class TestWealthAttachment(unittest.TestCase):
+    """Test case for the bulk wealth-based preferential attachment generator"""
+    
+    pop=20
+    reps=400
+    
+    def setUp(self):
+        """Fix the random state and the wealth of a small population"""
+        np.random.seed(self.pop)
+        self.wealth=pareto(3.,size=self.pop)
+        self.state_wealth=self.wealth.sum()
+        
+    def loop_ties(self):
+        """Reference pairwise loop the generator replaces"""
+        ties=list()
+        for i in xrange(self.pop):
+            for j in xrange(self.pop):
+                if i!=j and uniform(low=0,high=1)<=self.wealth[j]/self.state_wealth:
+                    ties.append((i,j))
+        return ties
+        
+    def test_valid_ties(self):
+        """Test that no agent ties to itself and that each ordered pair is drawn at most once"""
+        for r in xrange(50):
+            sources,targets=wealth_attachment_ties(self.wealth,self.state_wealth)
+            self.assertFalse((sources==targets).any())
+            self.assertTrue(((sources>=0) & (sources<self.pop)).all())
+            self.assertEquals(len(set(zip(sources,targets))),len(sources))
+        
+    def test_equivalence(self):
+        """Test that per-agent degrees from the generator and from the pairwise 
+        loop agree within sampling error"""
+        loop_deg=np.zeros((self.reps,self.pop))
+        bulk_deg=np.zeros((self.reps,self.pop))
+        for r in xrange(self.reps):
+            ties=np.array(self.loop_ties(),dtype=int).reshape(-1,2)
+            loop_deg[r]=np.bincount(ties.ravel(),minlength=self.pop)
+            sources,targets=wealth_attachment_ties(self.wealth,self.state_wealth)
+            bulk_deg[r]=np.bincount(np.concatenate((sources,targets)),minlength=self.pop)
+        std_err=np.sqrt((loop_deg.var(axis=0)+bulk_deg.var(axis=0))/self.reps)
+        z=(loop_deg.mean(axis=0)-bulk_deg.mean(axis=0))/np.maximum(std_err,1e-12)
+        self.assertTrue(np.abs(z).max()<4.5)
+        # Both should match the analytic expectation of the total number of ties
+        tie_probs=self.wealth/self.state_wealth
+        expected=(self.pop-1)*tie_probs.sum()
+        for deg in (loop_deg,bulk_deg):
+            total=deg.sum(axis=1)/2.
+            self.assertTrue(abs(total.mean()-expected)<4.5*total.std()/np.sqrt(self.reps))
+            
 
 if __name__ == '__main__':
     unittest.main()